@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Бенчмарк поиска повторных багов: MinHash/LSH-индекс против полного перебора открытых багов.
+
+Синтетические отчёты собираются из игровой лексики; каждый запрос — перефразированная
+копия существующего отчёта (перестановка и замена слов) или новый текст.
+
+Запуск из корня репозитория: python benchmarks/bench_duplicates.py --sizes 1000 10000 50000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+WORDS = (
+    "не работает пропал сломался вылетает зависает кнопка меню вход лаунчер чат карта спавн приват "
+    "регион донат магазин сундук инвентарь предмет блок зомби лаг пинг плагин команда права бан мут "
+    "кик репорт гриф читы скин ник аккаунт пароль сайт форум баланс монеты кейс ключ аукцион обмен "
+    "квест награда уровень опыт клан база портал энд незер вода лава крафт печь зелье броня меч лук"
+).split()
+
+
+def report(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(6, 16)))
+
+
+def paraphrase(rng, text):
+    words = text.split()
+    i = rng.randrange(len(words))
+    words[i] = rng.choice(WORDS)
+    if rng.random() < 0.5:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+
+def linear_find(index, text):
+    signature = index.signature(text)
+    best = None
+    for bug_id, other in index._signatures.items():
+        similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+        if similarity >= index.threshold and (best is None or similarity > best[1]):
+            best = (bug_id, similarity)
+    return best
+
+
+def run(size, queries, seed=7):
+    rng = random.Random(seed)
+    index = main.DuplicateIndex()
+    texts = [report(rng) for _ in range(size)]
+    for bug_id, text in enumerate(texts, 1):
+        index.add(bug_id, text)
+
+    probes = []
+    for _ in range(queries):
+        if rng.random() < 0.5:
+            bug_id = rng.randrange(1, size + 1)
+            probes.append((bug_id, paraphrase(rng, texts[bug_id - 1])))
+        else:
+            probes.append((None, report(rng)))
+
+    started = time.perf_counter()
+    lsh = [index.find(text) for _, text in probes]
+    lsh_ms = (time.perf_counter() - started) * 1000 / queries
+    started = time.perf_counter()
+    exact = [linear_find(index, text) for _, text in probes]
+    linear_ms = (time.perf_counter() - started) * 1000 / queries
+
+    found = sum(1 for hit in exact if hit is not None)
+    agreed = sum(1 for a, b in zip(lsh, exact) if (a and a[0]) == (b and b[0]))
+    print(f"открытых багов {size:7d}   LSH {lsh_ms:7.2f} мс   перебор {linear_ms:8.2f} мс   "
+          f"повторов найдено перебором {found}, LSH нашёл те же {agreed}/{queries}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.queries)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Микробенчмарк слоя репозиториев: действие админа с ТЗ «как было» и «как стало».
+
+Было: отдельное соединение на каждый вызов, INSERT + commit + SELECT last_insert_rowid(),
+UPDATE + commit и ещё одно соединение для get_task_by_id.
+Стало: пул соединений, INSERT/UPDATE ... RETURNING через групповую фиксацию.
+
+Запуск из корня репозитория: python benchmarks/bench_repository.py --actions 500
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import aiosqlite
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+async def legacy_create_task(path, author_id, author_username, description):
+    async with aiosqlite.connect(path) as db:
+        await db.execute(
+            "INSERT INTO tasks (author_id, author_username, description, media_file_id) VALUES (?, ?, ?, ?)",
+            (author_id, author_username, description, None)
+        )
+        await db.commit()
+        async with db.execute("SELECT last_insert_rowid()") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def legacy_admin_action(path, task_id):
+    async with aiosqlite.connect(path) as db:
+        await db.execute(
+            """UPDATE tasks SET status = ?, assigned_admin_id = ?, assigned_admin_username = ?,
+               updated_at = CURRENT_TIMESTAMP WHERE id = ?""",
+            ("completed", 1, "@admin", task_id)
+        )
+        await db.commit()
+    async with aiosqlite.connect(path) as db:
+        async with db.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)) as cursor:
+            return await cursor.fetchone()
+
+
+async def measure(name, actions, make_call):
+    timings = []
+    for i in range(actions):
+        started = time.perf_counter()
+        await make_call(i)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    p50 = statistics.median(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name:<34} среднее {statistics.mean(timings):7.3f} мс   p50 {p50:7.3f} мс   p99 {p99:7.3f} мс")
+    return statistics.mean(timings)
+
+
+async def run(actions):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        main.db_pool.path = path
+        await main.init_db()
+        try:
+            legacy_ids = []
+            new_ids = []
+
+            async def legacy_create(i):
+                legacy_ids.append(await legacy_create_task(path, 1, "@author", f"ТЗ {i}"))
+
+            async def new_create(i):
+                new_ids.append((await main.create_task(1, "@author", f"ТЗ {i}")).id)
+
+            print(f"Действий: {actions}\n")
+            old_create = await measure("create_task (было)", actions, legacy_create)
+            cur_create = await measure("create_task (стало)", actions, new_create)
+            old_action = await measure("статус + автор (было)", actions,
+                                       lambda i: legacy_admin_action(path, legacy_ids[i]))
+            cur_action = await measure("статус + автор (стало)", actions,
+                                       lambda i: main.update_task_status(new_ids[i], "completed", 1, "@admin"))
+            print(f"\nЭкономия на создании: {old_create - cur_create:.3f} мс/действие "
+                  f"(x{old_create / cur_create:.1f})")
+            print(f"Экономия на действии админа: {old_action - cur_action:.3f} мс/действие "
+                  f"(x{old_action / cur_action:.1f})")
+        finally:
+            await main.write_batcher.close()
+            await main.db_pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--actions", type=int, default=300, help="количество действий в каждом замере")
+    asyncio.run(run(parser.parse_args().actions))
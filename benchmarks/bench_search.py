@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Бенчмарк /search: время ранжированного поиска FTS5 (bm25) на больших таблицах.
+
+Заполняет tasks и bugs синтетическими описаниями (частоты слов — по закону Ципфа, как в
+живом тексте), индекс строят триггеры миграции. Затем замеряет main.search() для частых,
+средних и редких слов.
+
+Запуск из корня репозитория: python benchmarks/bench_search.py --rows 1000000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+WORDS = (
+    "сервер игрок кнопка меню ошибка вход лаунчер чат модератор карта мир спавн приват регион "
+    "донат магазин сундук инвентарь предмет блок зомби лаг пинг тпс плагин команда права бан "
+    "мут кик репорт жалоба гриф читы проверка скин ник аккаунт пароль почта сайт форум вики "
+    "таблица топ баланс монеты кейс ключ аукцион торговля обмен квест награда уровень опыт "
+    "клан война база портал энд незер вода лава огонь крафт печь зелье броня меч лук стрела"
+).split()
+
+
+def fill(path, rows, seed=42):
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    for table in ("tasks", "bugs"):
+        batch = []
+        for i in range(rows // 2):
+            words = rng.choices(WORDS, weights, k=rng.randint(8, 30))
+            batch.append((i % 5000, f"@user{i % 5000}", " ".join(words)))
+            if len(batch) == 50000:
+                conn.executemany(
+                    f"INSERT INTO {table} (author_id, author_username, description) VALUES (?, ?, ?)", batch
+                )
+                batch = []
+        if batch:
+            conn.executemany(
+                f"INSERT INTO {table} (author_id, author_username, description) VALUES (?, ?, ?)", batch
+            )
+        conn.commit()
+    conn.execute("INSERT INTO tasks_fts (tasks_fts) VALUES ('optimize')")
+    conn.execute("INSERT INTO bugs_fts (bugs_fts) VALUES ('optimize')")
+    conn.commit()
+    conn.close()
+
+
+async def measure(query, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        hits = await main.search(query)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{query!r:<28} найдено {len(hits):3d}   p50 {statistics.median(timings):7.2f} мс   "
+          f"макс {timings[-1]:7.2f} мс")
+
+
+async def run(rows, repeats):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "search.db")
+        main.db_pool.path = path
+        await main.init_db()
+        await main.write_batcher.close()
+        await main.db_pool.close()
+
+        started = time.perf_counter()
+        fill(path, rows)
+        print(f"Заполнено {rows} строк с индексацией триггерами за {time.perf_counter() - started:.1f} с\n")
+
+        await main.db_pool.open()
+        try:
+            for query in ("сервер", "ошибка вход", "лаунчер", "клан война", "стрела",
+                          "зелье броня меч", "серв", "несуществующееслово"):
+                await measure(query, repeats)
+        finally:
+            await main.db_pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="строк в tasks и bugs вместе")
+    parser.add_argument("--repeats", type=int, default=20, help="повторов каждого запроса")
+    args = parser.parse_args()
+    asyncio.run(run(args.rows, args.repeats))
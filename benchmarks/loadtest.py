@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест бота без Telegram: настоящие обработчики против локальной заглушки Bot API.
+
+Каждый виртуальный пользователь проходит один из сценариев — создание ТЗ, жизненный цикл бага
+(в работу → выполнено) или заявку из 7 вопросов — а виртуальный админ нажимает кнопки в
+сообщениях, которые бот отправил в заглушку. Обновления идут через очередь Application
+(как в режиме вебхука), ответы Bot API задерживаются и иногда возвращают 429.
+
+    python benchmarks/loadtest.py --users 10 100 1000
+    python benchmarks/loadtest.py --users 100 --latency-ms 80 --rate-429 0.02 --telegram-limits
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Load", "username": "load_bot"}
+ADMIN_IDS = [7000000001, 7000000002]
+FIRST_USER_ID = 100000
+STUB_METHODS = [
+    "getMe", "sendMessage", "sendPhoto", "sendVideo", "editMessageText", "editMessageCaption",
+    "editMessageReplyMarkup", "answerCallbackQuery",
+]
+USERNAME_RE = re.compile(r"@(load\d{7})")
+
+
+def username_of(user_id):
+    return f"load{user_id:07d}"
+
+
+class StubBotApi:
+    """Заглушка Bot API: задержка ответа, случайные 429 и память об отправленных сообщениях"""
+
+    def __init__(self, latency, rate_429, retry_after):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = 0
+        self.flood_errors = 0
+        self.messages = {}   # (chat_id, message_id) -> сообщение в формате Bot API
+        self._tagged = {}    # (chat_id, username) -> message_id сообщения с кнопками
+        self._waiters = {}   # (chat_id, username) -> future
+        self._ids = itertools.count(1)
+        self.server = None
+
+    async def start(self, main):
+        self.server = main.LocalHttpServer("127.0.0.1", 0)
+        for method in STUB_METHODS:
+            self.server.route("POST", f"/bot{TOKEN}/{method}", self._make_handler(method))
+        await self.server.start()
+        return f"http://127.0.0.1:{self.server.port}/bot"
+
+    async def stop(self):
+        await self.server.stop()
+
+    def _make_handler(self, method):
+        async def handle(body, headers):
+            self.calls += 1
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            if method != "getMe" and random.random() < self.rate_429:
+                self.flood_errors += 1
+                return 429, "application/json", json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }).encode()
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            result = self._apply(method, params)
+            return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+        return handle
+
+    def _apply(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "answerCallbackQuery":
+            return True
+        chat_id = int(params["chat_id"])
+        markup = json.loads(params["reply_markup"]) if "reply_markup" in params else None
+        text = params.get("text", params.get("caption", ""))
+        if method.startswith("edit"):
+            message = self.messages[(chat_id, int(params["message_id"]))]
+            if method != "editMessageReplyMarkup":
+                message["text"] = text
+            if markup:
+                message["reply_markup"] = markup
+            else:
+                message.pop("reply_markup", None)
+            return message
+
+        message = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+            "text": text,
+        }
+        if markup:
+            message["reply_markup"] = markup
+        self.messages[(chat_id, message["message_id"])] = message
+        tag = USERNAME_RE.search(text)
+        if markup and tag:
+            key = (chat_id, tag.group(1))
+            self._tagged[key] = message["message_id"]
+            waiter = self._waiters.pop(key, None)
+            if waiter and not waiter.done():
+                waiter.set_result(message["message_id"])
+        return message
+
+    async def wait_message(self, chat_id, username, timeout=60):
+        """Дождаться сообщения с кнопками о пользователе username в чате chat_id"""
+        key = (chat_id, username)
+        if key not in self._tagged:
+            future = self._waiters.setdefault(key, asyncio.get_running_loop().create_future())
+            await asyncio.wait_for(future, timeout)
+        return self.messages[(chat_id, self._tagged[key])]
+
+
+class LoadDriver:
+    """Подаёт синтетические обновления в Application и замеряет время до конца обработки"""
+
+    def __init__(self, application, think_time):
+        self.application = application
+        self.think_time = think_time
+        self.latencies = []
+        self.errors = 0
+        self._pending = {}   # update_id -> (начало, future)
+        self._ids = itertools.count(1)
+
+    async def on_processed(self, update, context):
+        started, future = self._pending.pop(update.update_id)
+        self.latencies.append((time.perf_counter() - started) * 1000)
+        future.set_result(None)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+
+    async def feed(self, payload):
+        from telegram import Update
+        update_id = next(self._ids)
+        payload["update_id"] = update_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[update_id] = (time.perf_counter(), future)
+        await self.application.update_queue.put(Update.de_json(payload, self.application.bot))
+        await future
+        if self.think_time:
+            await asyncio.sleep(self.think_time * random.uniform(0.5, 1.5))
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "Load", "username": username_of(user_id)}
+
+    def text(self, user_id, text):
+        message = {
+            "message_id": 1, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id),
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self.feed({"message": message})
+
+    def press(self, user_id, data, message=None):
+        if message is None:
+            message = {
+                "message_id": 1, "date": int(time.time()), "text": "меню",
+                "chat": {"id": user_id, "type": "private"}, "from": BOT_USER,
+            }
+        return self.feed({"callback_query": {
+            "id": str(next(self._ids)), "from": self._user(user_id), "chat_instance": "load",
+            "data": data, "message": message,
+        }})
+
+
+BUG_WORDS = (
+    "кнопка меню вход лаунчер чат карта спавн приват регион донат магазин сундук инвентарь предмет "
+    "зомби пинг плагин команда права аккаунт пароль сайт форум баланс монеты кейс ключ аукцион обмен"
+).split()
+
+
+def bug_report(user_id):
+    """Отчёты с общим шаблоном и разной сутью: бот не должен принимать их за повторы"""
+    rng = random.Random(user_id)
+    return "Не работает после перезахода на сервер: " + " ".join(rng.sample(BUG_WORDS, 8))
+
+
+def button(message, index):
+    return message["reply_markup"]["inline_keyboard"][0][index]["callback_data"]
+
+
+async def task_flow(driver, stub, user_id):
+    admin_id = ADMIN_IDS[user_id % len(ADMIN_IDS)]
+    await driver.text(user_id, "/start")
+    await driver.press(user_id, "create_task")
+    await driver.text(user_id, f"Сделать страницу отчёта для пользователя {user_id}")
+    await driver.text(user_id, "/skip")
+    await driver.press(user_id, "confirm_task")
+    message = await stub.wait_message(admin_id, username_of(user_id))
+    await driver.press(admin_id, button(message, user_id % 2), message)
+
+
+async def bug_flow(driver, stub, user_id):
+    from main import GROUP_CHAT_ID
+    admin_id = ADMIN_IDS[user_id % len(ADMIN_IDS)]
+    await driver.text(user_id, "/start")
+    await driver.press(user_id, "create_bug")
+    await driver.text(user_id, bug_report(user_id))
+    await driver.text(user_id, "/skip_bug")
+    await driver.press(user_id, "confirm_bug")
+    message = await stub.wait_message(GROUP_CHAT_ID, username_of(user_id))
+    await driver.press(admin_id, button(message, 1), message)  # 🟡 Выполняется
+    # Второе нажатие — сразу, в окне отложенной перерисовки поста
+    message = stub.messages[(GROUP_CHAT_ID, message["message_id"])]
+    await driver.press(admin_id, button(message, 0 if user_id % 2 else 1), message)  # 🟢 Выполнено / 🔴 Отклонено
+
+
+async def application_flow(driver, stub, user_id):
+    from main import GROUP_CHAT_ID, QUESTIONS
+    admin_id = ADMIN_IDS[user_id % len(ADMIN_IDS)]
+    await driver.text(user_id, "/start")
+    await driver.press(user_id, "apply_to_team")
+    await driver.press(user_id, "apply_helper")
+    for i in range(len(QUESTIONS)):
+        await driver.text(user_id, f"Ответ {i + 1}")
+    await driver.press(user_id, "confirm_application")
+    message = await stub.wait_message(GROUP_CHAT_ID, username_of(user_id))
+    await driver.press(admin_id, button(message, user_id % 2), message)
+
+
+FLOWS = [task_flow, bug_flow, application_flow]
+
+
+def run_level(users, args, results):
+    import main
+    from telegram.ext import TypeHandler
+    from telegram import Update
+
+    # main настраивает логирование при импорте — глушим его уже после
+    logging.getLogger().setLevel(logging.ERROR)
+
+    if not args.telegram_limits:
+        # Лимиты Telegram ограничили бы пропускную способность, а не бота
+        main.TELEGRAM_PRIVATE_RATE = main.TELEGRAM_GROUP_RATE = 1e6
+        main.flood_limiter.global_bucket = main.TokenBucket(1e6, 1e6)
+    main.metrics.enabled = args.metrics
+    main.metrics.port = 0
+
+    async def run():
+        stub = StubBotApi(args.latency_ms / 1000, args.rate_429, args.retry_after)
+        base_url = await stub.start(main)
+        application = main.build_application(TOKEN, args.concurrency, base_url)
+        driver = LoadDriver(application, args.think_ms / 1000)
+        # Отметка об обработке — в группе после всех групп бота
+        application.add_handler(TypeHandler(Update, driver.on_processed), group=max(application.handlers) + 1)
+        application.add_error_handler(driver.on_error)
+
+        flows_done = flows_failed = 0
+        # Время и число обновлений на момент завершения последнего успешного сценария
+        finished = processed = 0
+        async with application:
+            await main.on_startup(application)
+            await application.start()
+            try:
+                for admin_id in ADMIN_IDS:
+                    await main.add_admin(admin_id, f"@admin{admin_id}")
+
+                async def user(user_id):
+                    nonlocal flows_done, flows_failed, finished, processed
+                    try:
+                        await FLOWS[user_id % len(FLOWS)](driver, stub, user_id)
+                    except asyncio.TimeoutError:
+                        flows_failed += 1
+                        return
+                    flows_done += 1
+                    finished, processed = time.perf_counter(), len(driver.latencies)
+
+                started = time.perf_counter()
+                await asyncio.gather(*(user(FIRST_USER_ID + i) for i in range(users)))
+                # Таймауты упавших сценариев не входят во время прогона
+                elapsed = finished - started if flows_done else 0
+            finally:
+                await application.stop()
+                await main.on_stop(application)
+                await main.on_shutdown(application)
+                await stub.stop()
+
+        return {
+            "users": users,
+            "elapsed": elapsed,
+            "processed": processed,
+            "latencies": driver.latencies,
+            "errors": driver.errors,
+            "flows_done": flows_done,
+            "flows_failed": flows_failed,
+            "api_calls": stub.calls,
+            "flood_errors": stub.flood_errors,
+            "lock_retries": main.db_pool.lock_retries,
+            "batches": main.write_batcher.batches,
+            "operations": main.write_batcher.operations,
+            "metrics": main.format_metrics() if args.metrics else "",
+        }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.db_pool.path = os.path.join(tmp, "load.db")
+        results.put(asyncio.run(run()))
+
+
+def report(row):
+    """Печатает итоги прогона; возвращает False, если прогон не чистый"""
+    latencies = sorted(row["latencies"])
+    p50 = statistics.median(latencies) if latencies else 0
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0
+    per_batch = row["operations"] / row["batches"] if row["batches"] else 0
+    clean = not row["flows_failed"] and not row["errors"]
+    print(f"\nПользователей: {row['users']}")
+    if not clean:
+        print(f"  ❌ ПРОГОН НЕ ЧИСТЫЙ: {row['flows_failed']} сценариев не дождались ответа, "
+              f"ошибок в обработчиках {row['errors']}")
+    print(f"  сценариев: {row['flows_done']} завершено, {row['flows_failed']} не дождались ответа")
+    if row["elapsed"]:
+        print(f"  обновлений: {row['processed']} до конца последнего завершённого сценария "
+              f"за {row['elapsed']:.2f} с — {row['processed'] / row['elapsed']:.1f} обн/с")
+    print(f"  задержка обработки: p50 {p50:.1f} мс   p99 {p99:.1f} мс")
+    print(f"  Bot API: {row['api_calls']} запросов, из них 429: {row['flood_errors']}")
+    print(f"  БД: {row['operations']} записей в {row['batches']} коммитах ({per_batch:.1f} на коммит), "
+          f"повторов при блокировке {row['lock_retries']}")
+    if row["metrics"]:
+        print("  " + row["metrics"].replace("\n", "\n  "))
+    return clean
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 100, 1000],
+                        help="число одновременных пользователей (по прогону на каждое значение)")
+    parser.add_argument("--latency-ms", type=float, default=30, help="средняя задержка ответа Bot API")
+    parser.add_argument("--rate-429", type=float, default=0.005, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429 (сек)")
+    parser.add_argument("--think-ms", type=float, default=0, help="пауза пользователя между действиями")
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременно обрабатываемых обновлений")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="оставить лимиты Telegram в планировщике отправки (30/с, 1/с в личку)")
+    parser.add_argument("--metrics", action="store_true", help="показать самые затратные участки")
+    args = parser.parse_args()
+
+    # Каждый прогон — в отдельном процессе: свой пул БД, очередь отправки и цикл событий
+    ctx = multiprocessing.get_context("spawn")
+    clean = True
+    for users in args.users:
+        results = ctx.Queue()
+        process = ctx.Process(target=run_level, args=(users, args, results))
+        process.start()
+        while True:
+            try:
+                row = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    sys.exit(f"Прогон на {users} пользователей завершился с ошибкой")
+        process.join()
+        clean = report(row) and clean
+    if not clean:
+        sys.exit("Нагрузочный тест не прошёл: есть упавшие сценарии или ошибки обработчиков")
+
+
+if __name__ == "__main__":
+    main_cli()
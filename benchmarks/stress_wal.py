@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Стресс-тест конкурентного доступа к tasks.db: процессы-читатели (как server.js) и процессы-писатели (бот).
+
+Писатели используют настоящий слой записи бота (пул, групповая фиксация, повтор при блокировке),
+читатели — обычный sqlite3 с запросами веб-сервера. Сравнение режимов журнала:
+
+    python benchmarks/stress_wal.py --journal wal
+    python benchmarks/stress_wal.py --journal delete
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def configure_main(path, journal):
+    import main
+    main.db_pool.path = path
+    if journal != "wal":
+        main.DB_PRAGMAS = [(name, journal.upper() if name == "journal_mode" else value)
+                           for name, value in main.DB_PRAGMAS]
+    return main
+
+
+def reader_process(path, seconds, busy_ms, results):
+    conn = sqlite3.connect(path, timeout=busy_ms / 1000)
+    ok = locked = 0
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.execute("SELECT * FROM tasks ORDER BY created_at DESC LIMIT 50").fetchall()
+            conn.execute("SELECT COUNT(*) FROM bugs").fetchone()
+            ok += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            locked += 1
+    conn.close()
+    results.put(("reader", ok, locked, latencies, 0))
+
+
+def writer_process(path, journal, seconds, results):
+    main = configure_main(path, journal)
+
+    async def run():
+        await main.db_pool.open()
+        ok = failed = 0
+        latencies = []
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    task = await main.create_task(1, "@stress", "нагрузка " * 20)
+                    await main.update_task_status(task.id, "completed", 2, "@admin")
+                    ok += 1
+                    latencies.append((time.perf_counter() - started) * 1000)
+                except sqlite3.OperationalError:
+                    failed += 1
+        finally:
+            await main.write_batcher.close()
+            await main.db_pool.close()
+        return ok, failed, latencies, main.db_pool.lock_retries
+
+    ok, failed, latencies, retries = asyncio.run(run())
+    results.put(("writer", ok, failed, latencies, retries))
+
+
+def report(kind, rows):
+    ok = sum(r[1] for r in rows)
+    errors = sum(r[2] for r in rows)
+    latencies = sorted(x for r in rows for x in r[3])
+    retries = sum(r[4] for r in rows)
+    p50 = statistics.median(latencies) if latencies else 0
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    label = "читатели" if kind == "reader" else "писатели"
+    line = f"{label:<9} успешно {ok:7d}   ошибок блокировки {errors:5d}   p50 {p50:7.2f} мс   p99 {p99:7.2f} мс"
+    if kind == "writer":
+        line += f"   повторов при блокировке {retries}"
+    print(line)
+    return errors
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--journal", choices=["wal", "delete"], default="wal")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--reader-busy-ms", type=int, default=5000,
+                        help="busy_timeout читателей (server.js теперь использует 5000)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stress.db")
+        main = configure_main(path, args.journal)
+
+        async def prepare():
+            await main.init_db()
+            for i in range(200):
+                await main.create_task(1, "@seed", f"ТЗ {i}")
+            await main.write_batcher.close()
+            await main.db_pool.close()
+        asyncio.run(prepare())
+
+        # spawn: каждый процесс поднимает свой пул и цикл событий с нуля
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        processes = [
+            ctx.Process(target=reader_process, args=(path, args.seconds, args.reader_busy_ms, results))
+            for _ in range(args.readers)
+        ] + [
+            ctx.Process(target=writer_process, args=(path, args.journal, args.seconds, results))
+            for _ in range(args.writers)
+        ]
+        for process in processes:
+            process.start()
+        rows = [results.get(timeout=args.seconds + 60) for _ in processes]
+        for process in processes:
+            process.join()
+
+        print(f"\nРежим журнала: {args.journal}, читателей {args.readers}, писателей {args.writers}, "
+              f"{args.seconds:g} с")
+        errors = report("reader", [r for r in rows if r[0] == "reader"])
+        errors += report("writer", [r for r in rows if r[0] == "writer"])
+        sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,10 +3,29 @@
 
 import logging
 import asyncio
+import time
+import heapq
+import json
+import sys
+import argparse
+from http import HTTPStatus
+from collections import OrderedDict
+from typing import NamedTuple, Optional
 import aiosqlite
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+import sqlite3
+import functools
+import bisect
+import re
+import random
+import zlib
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
+from telegram.error import RetryAfter, NetworkError, BadRequest, Forbidden
+from telegram.ext import (
+    Application, ApplicationHandlerStop, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler,
+    CallbackQueryHandler, TypeHandler, filters, ContextTypes
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -23,12 +42,127 @@ TOPIC_THREAD_ID_BUGS = 2
 TOPIC_THREAD_ID_APPS = 54
 
 DB_PATH = "tasks.db"
-
-# Глобальные переменные для FSM
-USER_DATA = {}
-USER_BUG_DATA = {}
-USER_APPLICATION = {}
-ADMIN_USER_DATA = {}
+DB_READERS = 4  # Количество соединений для чтения в пуле
+WRITE_BATCH_WINDOW = 0      # Доп. ожидание перед групповой фиксацией (сек); 0 — пачка копится, пока идёт предыдущий коммит
+WRITE_BATCH_MAX = 100       # Фиксировать сразу, если накопилось столько операций
+
+# Профиль настроек SQLite; tasks.db общая с server.js, поэтому WAL: читатели не ждут писателя
+DB_PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),      # в WAL безопасно: fsync только на чекпоинте
+    ("busy_timeout", 5000),         # мс ожидания чужой блокировки
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -16000),         # ~16 МБ страниц на соединение
+    ("temp_store", "MEMORY"),
+]
+WAL_CHECKPOINT_INTERVAL = 300  # Период PRAGMA wal_checkpoint (сек)
+DB_LOCK_RETRIES = 5            # Повторов записи при "database is locked"
+DB_LOCK_BACKOFF = 0.05         # Начальная пауза между повторами (сек), удваивается
+ADMIN_REFRESH_INTERVAL = 300  # Период сверки кэша админов с БД (сек)
+
+# Лимиты Telegram Bot API
+TELEGRAM_GLOBAL_RATE = 30        # сообщений в секунду на всего бота
+TELEGRAM_PRIVATE_RATE = 1        # сообщений в секунду в один личный чат
+TELEGRAM_GROUP_RATE = 20 / 60    # сообщений в секунду в одну группу
+FANOUT_CONCURRENCY = 8           # одновременных отправок при рассылке админам
+FANOUT_MAX_ATTEMPTS = 3          # попыток доставки одному получателю
+OUTBOUND_MAX_IN_FLIGHT = 16      # одновременных запросов к Bot API из очереди отправки
+BUG_EDIT_DEBOUNCE = 2            # Окно (сек), за которое правки одного поста бага сливаются в одну
+
+# Очередь уведомлений авторам (outbox)
+OUTBOX_BATCH = 50                # Уведомлений, забираемых из очереди за раз
+OUTBOX_CONCURRENCY = 8           # Одновременных отправок
+OUTBOX_POLL_INTERVAL = 5         # Проверка очереди без пробуждения (сек): для повторов по расписанию
+OUTBOX_MAX_ATTEMPTS = 6          # Попыток доставки, после чего уведомление уходит в «мёртвые»
+OUTBOX_BACKOFF = 5               # Пауза перед первым повтором (сек), удваивается
+OUTBOX_LEASE = 60                # На сколько забранное уведомление скрыто от следующих выборок (сек)
+
+# Сводки новых ТЗ для админов, выбравших /digest
+DIGEST_INTERVAL = 15 * 60        # Период отправки сводок (сек)
+DIGEST_MAX_ITEMS = 10            # Сводка уходит сразу, как только у админа накопилось столько ТЗ
+DIGEST_PREVIEW_CHARS = 300       # Длина описания ТЗ в сводке
+
+# Рассылка /broadcast всем пользователям бота
+BROADCAST_PAGE = 100             # Получателей, читаемых из БД за раз; после каждой страницы — контрольная точка
+BROADCAST_PROGRESS_INTERVAL = 5  # Как часто обновлять сообщение с ходом рассылки (сек)
+
+# Приём обновлений
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]  # Типы обновлений, которые бот обрабатывает
+UPDATE_CONCURRENCY = 32          # Одновременно обрабатываемых обновлений (разных пользователей)
+UPDATE_BACKLOG_LIMIT = 4096      # Максимум обновлений, ожидающих своей очереди
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = None            # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+
+# Антифлуд перед обработчиками (админов не ограничивает)
+FLOOD_USER_RATE = 2              # обновлений в секунду от одного пользователя
+FLOOD_USER_BURST = 15            # запас ведра пользователя (альбом — до 10 сообщений разом)
+FLOOD_COMMAND_RATE = 0.5         # одной и той же команды/кнопки в секунду от одного пользователя
+FLOOD_COMMAND_BURST = 3
+FLOOD_MAX_BUCKETS = 10000        # при превышении полные (простаивающие) ведра выбрасываются
+
+# FSM-сессии пользователей
+SESSION_TTL = 24 * 3600          # Время жизни брошенного черновика (сек)
+SESSION_MAX_ENTRIES = 10000      # Максимум сессий в памяти
+SESSION_FLUSH_INTERVAL = 2       # Период отложенной записи сессий в БД (сек)
+SESSION_PURGE_INTERVAL = 600     # Период удаления просроченных сессий из БД (сек)
+
+# Списки ТЗ/багов для админов
+LIST_PAGE_SIZE = 10
+LIST_VIEWS = {
+    "active": {"tasks": ("pending",), "bugs": ("pending", "in_progress")},
+    "completed": {"tasks": ("completed",), "bugs": ("completed",)},
+    "rejected": {"tasks": ("rejected",), "bugs": ("rejected",)},
+}
+
+# Допустимые переходы статусов: {таблица: {из статуса: (в статусы)}}. Остальные кнопки устарели
+STATUS_TRANSITIONS = {
+    "tasks": {"pending": ("completed", "rejected")},
+    "bugs": {"pending": ("in_progress", "completed", "rejected"), "in_progress": ("completed", "rejected")},
+    "applications": {"pending": ("approved", "rejected")},
+}
+CALLBACK_DEDUPE_TTL = 300        # Сколько помнить обработанные callback_query.id (сек)
+CALLBACK_DEDUPE_MAX = 10000      # Максимум запомненных id
+
+# Статусы, которые считаются решением админа (для счётчиков /stats)
+RESOLVED_STATUSES = {
+    "tasks": ("completed", "rejected"),
+    "bugs": ("completed", "rejected"),
+    "applications": ("approved", "rejected"),
+}
+
+# Полнотекстовый поиск для админов
+SEARCH_PAGE_SIZE = 5
+SEARCH_MAX_RESULTS = 50          # Лучших совпадений в выдаче (дальше листать бессмысленно)
+SEARCH_CANDIDATES = 2000         # Самых свежих совпадений каждой таблицы, среди которых ранжирует bm25
+SEARCH_MAX_TERMS = 8             # Слов запроса, которые учитываются
+SEARCH_PREFIX_MAX = 8            # Слова ищутся по префиксу не длиннее этого (для него есть префиксный индекс)
+
+# Вложения ТЗ и багов
+ALBUM_WINDOW = 1.0               # Сколько ждать следующего сообщения альбома (сек), прежде чем показать предпросмотр
+ALBUM_MAX = 10                   # Максимум вложений (лимит sendMediaGroup)
+
+# Поиск повторных отчётов о багах (MinHash/LSH)
+DUPLICATE_SHINGLE = 2            # Слов в шингле (пары слов: общий шаблон вроде «не работает» не делает отчёты похожими)
+DUPLICATE_MIN_SHINGLES = 4       # Отчёты короче (меньше 5 слов) повторами не считаются
+DUPLICATE_BANDS = 20             # Полос LSH
+DUPLICATE_ROWS = 4               # Хешей в полосе (всего хешей MinHash — полосы × строки)
+DUPLICATE_THRESHOLD = 0.6        # Минимальное сходство (оценка Жаккара), чтобы считать отчёт повтором
+
+# Метрики задержек
+METRICS_ENABLED = False          # Замеры выключены по умолчанию (включаются флагом --metrics)
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9108              # Порт эндпоинта /metrics в формате Prometheus (0 — не поднимать)
+METRICS_BUCKETS = (0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_TOP = 15                 # Строк в отчёте /admin stats
+
+# Пауза между заявками одного пользователя; длина зависит от должности последней заявки
+APPLICATION_COOLDOWNS = {
+    "Хелпер": timedelta(days=7),
+    "Модератор": timedelta(days=7),
+}
+APPLICATION_COOLDOWN_DEFAULT = timedelta(days=7)
 
 # Вопросы для заявок
 QUESTIONS = [
@@ -41,223 +175,2430 @@ QUESTIONS = [
     "7. Время, которое вы готовы выделять на сервер в день (можно указать промежуток времени и дни)."
 ]
 
+# === МЕТРИКИ ===
+
+class Histogram:
+    """Гистограмма задержек с фиксированными границами корзин (сек)"""
+
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последняя корзина — +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.bounds, self.counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.bounds[-1]
+
+def prometheus_label(value: str) -> str:
+    """Экранировать значение метки для текстового формата Prometheus"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    """Гистограммы задержек горячих путей: обработчики, маршруты кнопок, запросы к БД и Bot API.
+
+    Пока enabled=False, обёртки сразу вызывают исходную функцию и ничего не замеряют.
+    """
+
+    # семейство -> (имя метрики, имя метки, описание)
+    FAMILIES = {
+        "handler": ("bot_handler_seconds", "handler", "Время обработчиков обновлений"),
+        "callback": ("bot_callback_route_seconds", "route", "Время маршрутов кнопок"),
+        "db": ("bot_db_seconds", "helper", "Время запросов к БД"),
+        "api": ("bot_api_seconds", "method", "Время запросов к Bot API"),
+        "api_wait": ("bot_api_queue_wait_seconds", "method", "Ожидание в очереди отправки"),
+    }
+
+    def __init__(self, enabled: bool = METRICS_ENABLED, buckets=METRICS_BUCKETS,
+                 host: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.host = host
+        self.port = port
+        self._series = {}  # (семейство, метка) -> Histogram
+        self._collectors = []  # функции, добавляющие в /metrics свои строки (счётчики)
+        self._server = None
+
+    def collect(self, func):
+        """Зарегистрировать func() -> [строки в формате Prometheus] для /metrics"""
+        self._collectors.append(func)
+
+    def observe(self, family: str, label: str, seconds: float):
+        histogram = self._series.get((family, label))
+        if histogram is None:
+            histogram = self._series[(family, label)] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    async def measure(self, family: str, label: str, awaitable):
+        """Дождаться awaitable, записав время ожидания"""
+        if not self.enabled:
+            return await awaitable
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.observe(family, label, time.perf_counter() - start)
+
+    def track(self, family: str, label: str = None):
+        """Декоратор корутины: замер каждого вызова под меткой label (по умолчанию — имя функции)"""
+        def decorator(func):
+            name = label or func.__name__
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await func(*args, **kwargs)
+                return await self.measure(family, name, func(*args, **kwargs))
+            return wrapper
+        return decorator
+
+    def top(self, limit: int = METRICS_TOP):
+        """Ряды с наибольшим суммарным временем: [(семейство, метка, Histogram)]"""
+        rows = [(family, label, h) for (family, label), h in self._series.items()]
+        rows.sort(key=lambda row: -row[2].total)
+        return rows[:limit]
+
+    def render(self) -> str:
+        """Все гистограммы в текстовом формате Prometheus"""
+        lines = []
+        for family, (metric, label_name, description) in self.FAMILIES.items():
+            series = sorted((label, h) for (f, label), h in self._series.items() if f == family)
+            if not series:
+                continue
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} histogram")
+            for label, h in series:
+                label = prometheus_label(label)
+                cumulative = 0
+                for bound, count in zip(self.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label_name}="{label}",le="+Inf"}} {h.count}')
+                lines.append(f'{metric}_sum{{{label_name}="{label}"}} {h.total}')
+                lines.append(f'{metric}_count{{{label_name}="{label}"}} {h.count}')
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+    async def _handle_scrape(self, body: bytes, headers: dict):
+        return 200, "text/plain; version=0.0.4; charset=utf-8", self.render().encode("utf-8")
+
+    async def start(self):
+        """Поднять локальный эндпоинт /metrics (если метрики включены и задан порт)"""
+        if not self.enabled or not self.port or self._server is not None:
+            return
+        self._server = LocalHttpServer(self.host, self.port)
+        self._server.route("GET", "/metrics", self._handle_scrape)
+        await self._server.start()
+
+    async def stop(self):
+        if self._server is not None:
+            await self._server.stop()
+            self._server = None
+
+metrics = Metrics()
+
 # === БАЗА ДАННЫХ ===
 
-async def init_db():
-    """Инициализация базы данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Админы
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT NOT NULL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+class DatabasePool:
+    """Пул долгоживущих соединений: один писатель и несколько читателей"""
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = readers
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._readers = None
+        self._all_readers = []
+        self.lock_retries = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path)
+        for name, value in DB_PRAGMAS:
+            await conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    async def open(self):
+        """Открыть соединения пула (один раз при старте)"""
+        if self.is_open:
+            return
+        self._writer = await self._connect()
+        self._readers = asyncio.Queue()
+        for _ in range(self.readers_count):
+            conn = await self._connect()
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+        logger.info(f"✅ Пул БД открыт: 1 писатель, {self.readers_count} читателей")
+
+    async def close(self):
+        """Закрыть все соединения пула"""
+        if not self.is_open:
+            return
+        async with self._writer_lock:
+            await self._writer.close()
+            self._writer = None
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers = []
+        self._readers = None
+        logger.info("✅ Пул БД закрыт")
+
+    @asynccontextmanager
+    async def writer(self):
+        """Эксклюзивный доступ к соединению-писателю; коммит при успехе, откат при ошибке"""
+        if not self.is_open:
+            raise RuntimeError("Пул БД не открыт")
+        async with self._writer_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    async def checkpoint(self):
+        """Перенести WAL в основной файл, не блокируя читателей"""
+        async with self._writer_lock:
+            async with self._writer.execute("PRAGMA wal_checkpoint(PASSIVE)") as cursor:
+                return await cursor.fetchone()
+
+    @asynccontextmanager
+    async def reader(self):
+        """Взять соединение для чтения из пула"""
+        if not self.is_open:
+            raise RuntimeError("Пул БД не открыт")
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+def is_lock_error(error: Exception) -> bool:
+    """Ошибка конкурентного доступа к файлу БД (его держит другой процесс, например server.js)"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+def retry_on_lock(func):
+    """Повторить запись с экспоненциальной паузой, если БД заблокирована другим процессом"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        delay = DB_LOCK_BACKOFF
+        for attempt in range(1, DB_LOCK_RETRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not is_lock_error(e) or attempt == DB_LOCK_RETRIES:
+                    raise
+                db_pool.lock_retries += 1
+                logger.warning(f"БД заблокирована ({func.__qualname__}), повтор через {delay:.2f} с")
+                await asyncio.sleep(delay)
+                delay *= 2
+    return wrapper
+
+class WriteBatcher:
+    """Групповая фиксация: записи, пришедшие за время предыдущего коммита (и окна window),
+    коммитятся следующей пачкой одной транзакцией. Одиночная запись уходит сразу.
+
+    submit() возвращает future, который разрешается результатом операции после коммита.
+    Каждая операция выполняется в своей точке сохранения: ошибка одной не откатывает остальные.
+    """
+
+    def __init__(self, pool: DatabasePool, window: float = WRITE_BATCH_WINDOW,
+                 max_batch: int = WRITE_BATCH_MAX):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []       # [(op, future)]
+        self._timer = None
+        self._flushing = None
+        self._closed = False
+        self.batches = 0
+        self.operations = 0
+
+    def submit(self, op) -> asyncio.Future:
+        """Поставить операцию async op(db) -> результат в очередь на групповую фиксацию"""
+        if self._closed:
+            raise RuntimeError("Групповая запись остановлена")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((op, future))
+        if len(self._pending) >= self.max_batch or self.window <= 0:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._schedule_flush)
+        return future
+
+    def execute(self, sql: str, params=()) -> asyncio.Future:
+        """Поставить в очередь один оператор; результат — число изменённых строк"""
+        async def op(db):
+            cursor = await db.execute(sql, params)
+            return cursor.rowcount
+        return self.submit(op)
+
+    def fetchone(self, sql: str, params=()) -> asyncio.Future:
+        """Поставить в очередь оператор с RETURNING; результат — первая строка или None"""
+        async def op(db):
+            cursor = await db.execute(sql, params)
+            row = await cursor.fetchone()
+            await cursor.close()
+            return row
+        return self.submit(op)
+
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is None and self._pending:
+            self._flushing = spawn(self._flush_loop())
+
+    async def _flush_loop(self):
+        try:
+            while self._pending:
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                await self._commit_batch(batch)
+        finally:
+            self._flushing = None
+            if self._pending and self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self._schedule_flush)
+
+    @metrics.track("db", "write_batch")
+    @retry_on_lock
+    async def _run_batch(self, batch):
+        """Выполнить пачку в одной транзакции; [(успех, результат)] по операциям"""
+        results = []
+        async with self.pool.writer() as db:
+            await db.execute("BEGIN")
+            if len(batch) == 1:
+                # Одиночной операции точка сохранения не нужна: ошибка откатит всю транзакцию
+                results.append((True, await batch[0][0](db)))
+            else:
+                for op, _ in batch:
+                    await db.execute("SAVEPOINT batch_op")
+                    try:
+                        results.append((True, await op(db)))
+                        await db.execute("RELEASE batch_op")
+                    except Exception as e:
+                        if is_lock_error(e):
+                            raise
+                        await db.execute("ROLLBACK TO batch_op")
+                        await db.execute("RELEASE batch_op")
+                        results.append((False, e))
+        return results
+
+    async def _commit_batch(self, batch):
+        try:
+            results = await self._run_batch(batch)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.operations += len(batch)
+        for (_, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    async def flush(self):
+        """Зафиксировать всё накопленное и дождаться коммита"""
+        self._schedule_flush()
+        while self._flushing is not None:
+            await asyncio.shield(self._flushing)
+
+    async def close(self):
+        """Хук остановки: дописать очередь и перестать принимать операции"""
+        self._closed = True
+        await self.flush()
+
+db_pool = DatabasePool(DB_PATH)
+write_batcher = WriteBatcher(db_pool)
+
+# Таблицы и текстовые колонки, по которым ищет /search
+SEARCH_COLUMNS = {
+    "tasks": ("description",),
+    "bugs": ("description",),
+    "applications": ("timezone", "moderation_experience", "other_projects", "cheat_check_knowledge",
+                     "grif_experience", "age", "available_time"),
+}
+
+def _fts_statements(table: str, columns: tuple) -> list:
+    """FTS5-индекс с внешним содержимым над table и триггеры, поддерживающие его в актуальном виде"""
+    fts = f"{table}_fts"
+    cols = ", ".join(columns)
+    new = ", ".join(f"new.{c}" for c in columns)
+    old = ", ".join(f"old.{c}" for c in columns)
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            {cols}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+            prefix='{" ".join(str(n) for n in range(2, SEARCH_PREFIX_MAX + 1))}'
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old});
+        END""",
+        # Смена статуса текст не трогает — индекс переписывается только при правке текста
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {cols} ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old});
+            INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new});
+        END""",
+        f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')",
+    ]
 
-        # Технические задания
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                author_id INTEGER NOT NULL,
-                author_username TEXT NOT NULL,
-                description TEXT NOT NULL,
-                media_file_id TEXT,
-                status TEXT NOT NULL DEFAULT 'pending',
-                assigned_admin_id INTEGER,
-                assigned_admin_username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+def _counter_statements(table: str, resolved: tuple) -> list:
+    """Триггеры, поддерживающие status_counters и admin_resolved для table, и их начальное заполнение"""
+    done = ", ".join(f"'{status}'" for status in resolved)
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_counters_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO status_counters (entity, status, count) VALUES ('{table}', new.status, 1)
+                ON CONFLICT (entity, status) DO UPDATE SET count = count + 1;
+            INSERT INTO admin_resolved (admin_id, entity, count)
+                SELECT new.assigned_admin_id, '{table}', 1
+                WHERE new.status IN ({done}) AND new.assigned_admin_id IS NOT NULL
+                ON CONFLICT (admin_id, entity) DO UPDATE SET count = count + 1;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_counters_delete AFTER DELETE ON {table} BEGIN
+            UPDATE status_counters SET count = count - 1 WHERE entity = '{table}' AND status = old.status;
+            UPDATE admin_resolved SET count = count - 1
+                WHERE admin_id = old.assigned_admin_id AND entity = '{table}' AND old.status IN ({done});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_counters_status AFTER UPDATE OF status ON {table}
+            WHEN old.status IS NOT new.status BEGIN
+            UPDATE status_counters SET count = count - 1 WHERE entity = '{table}' AND status = old.status;
+            INSERT INTO status_counters (entity, status, count) VALUES ('{table}', new.status, 1)
+                ON CONFLICT (entity, status) DO UPDATE SET count = count + 1;
+        END""",
+        # Решение переходит от старого админа к новому, если сменился статус или исполнитель
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_counters_resolved AFTER UPDATE OF status, assigned_admin_id ON {table}
+            WHEN old.status IS NOT new.status OR old.assigned_admin_id IS NOT new.assigned_admin_id BEGIN
+            UPDATE admin_resolved SET count = count - 1
+                WHERE admin_id = old.assigned_admin_id AND entity = '{table}' AND old.status IN ({done});
+            INSERT INTO admin_resolved (admin_id, entity, count)
+                SELECT new.assigned_admin_id, '{table}', 1
+                WHERE new.status IN ({done}) AND new.assigned_admin_id IS NOT NULL
+                ON CONFLICT (admin_id, entity) DO UPDATE SET count = count + 1;
+        END""",
+        f"""INSERT INTO status_counters (entity, status, count)
+            SELECT '{table}', status, COUNT(*) FROM {table} GROUP BY status""",
+        f"""INSERT INTO admin_resolved (admin_id, entity, count)
+            SELECT assigned_admin_id, '{table}', COUNT(*) FROM {table}
+            WHERE status IN ({done}) AND assigned_admin_id IS NOT NULL GROUP BY assigned_admin_id""",
+    ]
 
+# Миграции схемы: (версия, описание, SQL-операторы). Применяются по порядку,
+# каждая в своей транзакции; номер последней применённой хранится в PRAGMA user_version.
+MIGRATIONS = [
+    (1, "Базовая схема", [
+        # Админы
+        """CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        # Технические задания
+        """CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            author_id INTEGER NOT NULL,
+            author_username TEXT NOT NULL,
+            description TEXT NOT NULL,
+            media_file_id TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            assigned_admin_id INTEGER,
+            assigned_admin_username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
         # Баги
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS bugs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                author_id INTEGER NOT NULL,
-                author_username TEXT NOT NULL,
-                description TEXT NOT NULL,
-                media_file_id TEXT,
-                status TEXT NOT NULL DEFAULT 'pending',
-                assigned_admin_id INTEGER,
-                assigned_admin_username TEXT,
-                message_id_in_group INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
+        """CREATE TABLE IF NOT EXISTS bugs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            author_id INTEGER NOT NULL,
+            author_username TEXT NOT NULL,
+            description TEXT NOT NULL,
+            media_file_id TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            assigned_admin_id INTEGER,
+            assigned_admin_username TEXT,
+            message_id_in_group INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        # FSM-сессии (черновики ТЗ, багов, заявок и действия админ-панели)
+        """CREATE TABLE IF NOT EXISTS fsm_sessions (
+            user_id INTEGER PRIMARY KEY,
+            flow TEXT NOT NULL,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )""",
         # Заявки в команду
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS applications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                position TEXT NOT NULL,
-                timezone TEXT,
-                moderation_experience TEXT,
-                other_projects TEXT,
-                cheat_check_knowledge TEXT,
-                grif_experience TEXT,
-                age TEXT,
-                available_time TEXT,
-                status TEXT NOT NULL DEFAULT 'pending',
-                message_id_in_group INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.commit()
-        logger.info("✅ База данных инициализирована")
+        """CREATE TABLE IF NOT EXISTS applications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            position TEXT NOT NULL,
+            timezone TEXT,
+            moderation_experience TEXT,
+            other_projects TEXT,
+            cheat_check_knowledge TEXT,
+            grif_experience TEXT,
+            age TEXT,
+            available_time TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            message_id_in_group INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ]),
+    (2, "Индексы для горячих запросов", [
+        "CREATE INDEX IF NOT EXISTS idx_tasks_status_id ON tasks (status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_bugs_status_id ON bugs (status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_applications_user_created ON applications (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_fsm_sessions_expires ON fsm_sessions (expires_at)",
+    ]),
+    (3, "Полнотекстовый поиск", [
+        statement for table, columns in SEARCH_COLUMNS.items() for statement in _fts_statements(table, columns)
+    ]),
+    (4, "Повторные отчёты о багах", [
+        "ALTER TABLE bugs ADD COLUMN duplicate_of INTEGER",
+        "ALTER TABLE bugs ADD COLUMN duplicate_count INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_bugs_duplicate_of ON bugs (duplicate_of) WHERE duplicate_of IS NOT NULL",
+    ]),
+    (5, "Счётчики статусов для /stats", [
+        # Кто из админов принял решение по заявке (у ТЗ и багов эти колонки были изначально)
+        "ALTER TABLE applications ADD COLUMN assigned_admin_id INTEGER",
+        "ALTER TABLE applications ADD COLUMN assigned_admin_username TEXT",
+        """CREATE TABLE IF NOT EXISTS status_counters (
+            entity TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (entity, status)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS admin_resolved (
+            admin_id INTEGER NOT NULL,
+            entity TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (admin_id, entity)
+        ) WITHOUT ROWID""",
+    ] + [
+        statement for table, resolved in RESOLVED_STATUSES.items()
+        for statement in _counter_statements(table, resolved)
+    ]),
+    (6, "Текст постов багов, показанный в группе", [
+        "ALTER TABLE bugs ADD COLUMN post_rendered TEXT",
+    ]),
+    (7, "Вложения и реестр file_id", [
+        # Один файл Telegram (file_unique_id) хранится один раз, сколько бы отчётов на него ни ссылалось
+        """CREATE TABLE IF NOT EXISTS media_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_unique_id TEXT NOT NULL UNIQUE,
+            file_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        # media_file_id в tasks/bugs остаётся первым вложением (с ним работает server.js)
+        """CREATE TABLE IF NOT EXISTS attachments (
+            entity TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            media_id INTEGER NOT NULL REFERENCES media_files (id),
+            PRIMARY KEY (entity, item_id, position)
+        ) WITHOUT ROWID""",
+    ]),
+    (8, "Версии строк для оптимистичной блокировки", [
+        "ALTER TABLE tasks ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE bugs ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE applications ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (9, "Очередь уведомлений", [
+        # Доставленные уведомления удаляются; status = 'dead' — исчерпаны попытки или чат недоступен
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending'",
+    ]),
+    (10, "Пользователи бота и рассылки", [
+        # Все, кто писал боту в личку; blocked = 1 — бот заблокирован или чат недоступен
+        """CREATE TABLE IF NOT EXISTS bot_users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        # Начальное население — авторы ТЗ, багов и заявок
+        """INSERT OR IGNORE INTO bot_users (user_id, username)
+            SELECT author_id, author_username FROM tasks
+            UNION SELECT author_id, author_username FROM bugs
+            UNION SELECT user_id, username FROM applications""",
+        # last_user_id — контрольная точка: получателям с user_id до неё включительно уже отправлено
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            author_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )""",
+    ]),
+    (11, "Сводки новых ТЗ для админов", [
+        # immediate — каждое ТЗ отдельным сообщением, digest — сводкой раз в DIGEST_INTERVAL
+        "ALTER TABLE admins ADD COLUMN notify_mode TEXT NOT NULL DEFAULT 'immediate'",
+        """CREATE TABLE IF NOT EXISTS digest_queue (
+            admin_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            PRIMARY KEY (admin_id, task_id)
+        ) WITHOUT ROWID""",
+    ]),
+    (12, "Удаление неиспользуемого индекса заявок", [
+        # Последнюю заявку пользователя бот больше не ищет (паузы хранятся в памяти), а индекс
+        # замедлял каждую вставку в applications
+        "DROP INDEX IF EXISTS idx_applications_user_created",
+    ]),
+    (13, "Версия строки растёт при любой смене статуса", [
+        # server.js меняет статус без version — иначе бот не заметил бы эту смену и перезаписал её.
+        # Переходы самого бота уже увеличивают version, их триггер не трогает
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_version AFTER UPDATE OF status ON {table}
+            WHEN old.status IS NOT new.status AND new.version = old.version BEGIN
+            UPDATE {table} SET version = version + 1 WHERE id = new.id;
+        END"""
+        for table in ("tasks", "bugs", "applications")
+    ]),
+]
+
+# Горячие запросы бота для самопроверки планов (--check-db)
+HOT_QUERIES = [
+    ("get_task_by_id", "SELECT * FROM tasks WHERE id = ?", (1,)),
+    ("get_bug_by_id", "SELECT * FROM bugs WHERE id = ?", (1,)),
+    ("get_application_by_id", "SELECT * FROM applications WHERE id = ?", (1,)),
+    ("update_task_status",
+     "UPDATE tasks SET status = ?, version = version + 1 WHERE id = ? AND status IN (?) AND version = ? RETURNING id",
+     ("completed", 1, "pending", 0)),
+    ("fetch_page(tasks)",
+     "SELECT id, author_username, description, status FROM tasks "
+     "WHERE status = ? AND id < ? ORDER BY id DESC LIMIT ?", ("pending", 1, 11)),
+    ("fetch_page(bugs)",
+     "SELECT id, author_username, description, status FROM bugs "
+     "WHERE status = ? AND id < ? ORDER BY id DESC LIMIT ?", ("pending", 1, 11)),
+    ("sessions.get", "SELECT flow, data, expires_at FROM fsm_sessions WHERE user_id = ?", (1,)),
+    ("sessions.purge_expired", "DELETE FROM fsm_sessions WHERE expires_at < ?", (0,)),
+    ("search(tasks)",
+     "SELECT rowid, bm25(tasks_fts) FROM tasks_fts WHERE tasks_fts MATCH ? ORDER BY rowid DESC LIMIT ?",
+     ('"баг"*', 2000)),
+    ("get_stats", "SELECT entity, status, count FROM status_counters", ()),
+    ("outbox.due",
+     "SELECT id, chat_id, text, attempts FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+     "ORDER BY next_attempt_at LIMIT ?", (0, OUTBOX_BATCH)),
+    ("get_attachments",
+     "SELECT file_id, kind, file_unique_id FROM attachments JOIN media_files ON media_files.id = media_id "
+     "WHERE entity = ? AND item_id = ? ORDER BY position", ("bugs", 1)),
+    ("iter_recipients",
+     "SELECT user_id FROM bot_users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?",
+     (0, BROADCAST_PAGE)),
+    ("digests.pending",
+     "SELECT tasks.id, tasks.author_username, tasks.description, tasks.media_file_id, tasks.status, tasks.version "
+     "FROM digest_queue JOIN tasks ON tasks.id = digest_queue.task_id WHERE digest_queue.admin_id = ? "
+     "ORDER BY digest_queue.task_id LIMIT ?", (1, DIGEST_MAX_ITEMS)),
+    ("get_stats(admins)",
+     "SELECT admin_resolved.admin_id, admins.username, entity, count FROM admin_resolved "
+     "LEFT JOIN admins ON admins.user_id = admin_resolved.admin_id WHERE count > 0", ()),
+]
 
+async def migrate(db):
+    """Применить недостающие миграции; вернуть итоговую версию схемы"""
+    async with db.execute("PRAGMA user_version") as cursor:
+        current = (await cursor.fetchone())[0]
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        await db.execute("BEGIN")
+        try:
+            for statement in statements:
+                await db.execute(statement)
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            logger.error(f"❌ Миграция {version} ({description}) не применена")
+            raise
+        current = version
+        logger.info(f"✅ Миграция {version}: {description}")
+    return current
+
+async def init_db():
+    """Инициализация базы данных"""
+    await db_pool.open()
+    async with db_pool.writer() as db:
+        version = await migrate(db)
+    logger.info(f"✅ База данных инициализирована (версия схемы {version})")
+
+# Таблицы, размер которых не растёт с числом ТЗ/багов/заявок: полный просмотр для них не медленный
+BOUNDED_TABLES = ("status_counters", "admin_resolved")
+
+def is_slow_plan(detail: str) -> bool:
+    """Признаки медленного плана: полный просмотр таблицы или сортировка во временном B-дереве"""
+    if "TEMP B-TREE" in detail:
+        return True
+    if detail.startswith("SCAN") and detail.split()[1] in BOUNDED_TABLES:
+        return False
+    return detail.startswith("SCAN") and "USING" not in detail and "VIRTUAL TABLE" not in detail
+
+async def check_db() -> bool:
+    """Самопроверка: применить миграции и вывести EXPLAIN QUERY PLAN горячих запросов"""
+    await init_db()
+    # Читатели открыты до миграций и помнят прежнюю схему, а EXPLAIN её не перечитывает
+    await db_pool.close()
+    await db_pool.open()
+    ok = True
+    try:
+        async with db_pool.reader() as db:
+            for name, sql, params in HOT_QUERIES:
+                async with db.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+                    plan = [row[3] for row in await cursor.fetchall()]
+                slow = [detail for detail in plan if is_slow_plan(detail)]
+                ok = ok and not slow
+                print(f"{'⚠️' if slow else '✅'} {name}")
+                for detail in plan:
+                    print(f"      {detail}")
+    finally:
+        await db_pool.close()
+    return ok
+
+class AdminRegistry:
+    """Кэш администраторов в памяти: O(1) проверка и упорядоченный список без обращений к БД"""
+
+    def __init__(self):
+        self._admins = {}  # user_id -> username, в порядке добавления
+        self._digest = set()  # админы, получающие новые ТЗ сводкой
+
+    async def load(self):
+        """Загрузить (или перезагрузить) список админов из БД"""
+        async with db_pool.reader() as db:
+            async with db.execute(
+                "SELECT user_id, username, notify_mode FROM admins ORDER BY added_at, rowid"
+            ) as cursor:
+                rows = await cursor.fetchall()
+        admins = {user_id: username for user_id, username, _ in rows}
+        self._digest = {user_id for user_id, _, mode in rows if mode == "digest"}
+        if admins != self._admins:
+            self._admins = admins
+            logger.info(f"🔄 Кэш админов обновлён: {len(admins)}")
+
+    def contains(self, user_id: int) -> bool:
+        return user_id in self._admins
+
+    def list(self):
+        return list(self._admins.items())
+
+    def put(self, user_id: int, username: str):
+        """Записать изменение в кэш (существующий админ остаётся на своём месте и в своём режиме)"""
+        self._admins[user_id] = username
+
+    def wants_digest(self, user_id: int) -> bool:
+        return user_id in self._digest
+
+    def set_digest(self, user_id: int, enabled: bool):
+        if enabled:
+            self._digest.add(user_id)
+        else:
+            self._digest.discard(user_id)
+
+admin_registry = AdminRegistry()
+
+@metrics.track("db")
+@retry_on_lock
 async def add_admin(user_id: int, username: str):
     """Добавить администратора"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute(
-            "INSERT OR REPLACE INTO admins (user_id, username) VALUES (?, ?)",
+            """INSERT INTO admins (user_id, username) VALUES (?, ?)
+               ON CONFLICT (user_id) DO UPDATE SET username = excluded.username""",
             (user_id, username)
         )
-        await db.commit()
-        logger.info(f"✅ Добавлен админ: {username} (ID: {user_id})")
+    admin_registry.put(user_id, username)
+    logger.info(f"✅ Добавлен админ: {username} (ID: {user_id})")
 
 async def is_admin(user_id: int) -> bool:
     """Проверить, является ли пользователь администратором"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row is not None
+    return admin_registry.contains(user_id)
 
 async def get_admins():
     """Получить список всех администраторов"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT user_id, username FROM admins") as cursor:
-            return await cursor.fetchall()
+    return admin_registry.list()
 
-# === ФУНКЦИИ ДЛЯ ТЗ ===
+def set_notify_mode(user_id: int, digest: bool) -> asyncio.Future:
+    """Выбрать доставку новых ТЗ: сводкой или каждое отдельно (групповая фиксация)"""
+    admin_registry.set_digest(user_id, digest)
+    return write_batcher.execute("UPDATE admins SET notify_mode = ? WHERE user_id = ?",
+                                 ("digest" if digest else "immediate", user_id))
 
-async def create_task(author_id: int, author_username: str, description: str, media_file_id: str = None):
-    """Создать новое ТЗ"""
-    async with aiosqlite.connect(DB_PATH) as db:
+async def refresh_admins(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая сверка кэша админов с БД (на случай внешних изменений)"""
+    try:
+        await admin_registry.load()
+    except Exception as e:
+        logger.error(f"Не удалось обновить кэш админов: {e}")
+
+# === ТИПИЗИРОВАННЫЕ СТРОКИ ===
+
+class TaskRow(NamedTuple):
+    id: int
+    author_id: int
+    author_username: str
+    description: str
+    media_file_id: Optional[str]
+    status: str
+    assigned_admin_id: Optional[int]
+    assigned_admin_username: Optional[str]
+    created_at: str
+    updated_at: str
+    version: int
+
+class BugRow(NamedTuple):
+    id: int
+    author_id: int
+    author_username: str
+    description: str
+    media_file_id: Optional[str]
+    status: str
+    assigned_admin_id: Optional[int]
+    assigned_admin_username: Optional[str]
+    message_id_in_group: Optional[int]
+    created_at: str
+    updated_at: str
+    duplicate_of: Optional[int]
+    duplicate_count: int
+    post_rendered: Optional[str]
+    version: int
+
+class ApplicationRow(NamedTuple):
+    id: int
+    user_id: int
+    username: str
+    position: str
+    timezone: Optional[str]
+    moderation_experience: Optional[str]
+    other_projects: Optional[str]
+    cheat_check_knowledge: Optional[str]
+    grif_experience: Optional[str]
+    age: Optional[str]
+    available_time: Optional[str]
+    status: str
+    message_id_in_group: Optional[int]
+    created_at: str
+    updated_at: str
+    assigned_admin_id: Optional[int]
+    assigned_admin_username: Optional[str]
+    version: int
+
+class BroadcastRow(NamedTuple):
+    id: int
+    author_id: int
+    text: str
+    status: str
+    total: int
+    last_user_id: int
+    sent: int
+    blocked: int
+    failed: int
+    progress_chat_id: Optional[int]
+    progress_message_id: Optional[int]
+
+# Явные списки колонок, чтобы новые миграции не ломали распаковку строк
+TASK_COLUMNS = ", ".join(TaskRow._fields)
+BUG_COLUMNS = ", ".join(BugRow._fields)
+APPLICATION_COLUMNS = ", ".join(ApplicationRow._fields)
+BROADCAST_COLUMNS = ", ".join(BroadcastRow._fields)
+
+def _typed(row_type, row):
+    return row_type(*row) if row else None
+
+async def _returning(row_type, sql: str, params) -> NamedTuple:
+    """INSERT/UPDATE ... RETURNING через групповую фиксацию; строка приходит после коммита"""
+    return _typed(row_type, await write_batcher.fetchone(sql, params))
+
+async def _transition(row_type, table: str, columns: str, item_id: int, status: str, admin_id: int,
+                      admin_username: str, version: int = None, notify=None) -> Optional[NamedTuple]:
+    """Сменить статус одним условным UPDATE: только из допустимого статуса и только с той версии,
+    которую видел админ. None — запись не найдена, изменена другим админом или переход запрещён.
+
+    notify(db, row) ставит уведомления в outbox в той же транзакции, что и смена статуса.
+    """
+    sources = [old for old, targets in STATUS_TRANSITIONS[table].items() if status in targets]
+    if not sources:
+        return None
+    sql = f"""UPDATE {table} SET status = ?, assigned_admin_id = ?, assigned_admin_username = ?,
+        version = version + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status IN ({', '.join('?' * len(sources))})"""
+    params = [status, admin_id, admin_username, item_id, *sources]
+    if version is not None:
+        sql += " AND version = ?"
+        params.append(version)
+
+    async def op(db):
+        cursor = await db.execute(f"{sql} RETURNING {columns}", params)
+        row = await cursor.fetchone()
+        await cursor.close()
+        if row is not None and notify is not None:
+            await notify(db, row_type(*row))
+        return row
+    row = _typed(row_type, await write_batcher.submit(op))
+    if row is not None and notify is not None:
+        outbox.wake()
+    return row
+
+# === ВЛОЖЕНИЯ ===
+
+def _first_file_id(media: list) -> Optional[str]:
+    return media[0]["file_id"] if media else None
+
+async def _store_attachments(db, entity: str, item_id: int, media: list):
+    """Записать вложения записи; файлы, уже известные по file_unique_id, не дублируются"""
+    for position, item in enumerate(media):
         await db.execute(
-            """INSERT INTO tasks (author_id, author_username, description, media_file_id)
-               VALUES (?, ?, ?, ?)""",
-            (author_id, author_username, description, media_file_id)
+            "INSERT INTO media_files (file_unique_id, file_id, kind) VALUES (?, ?, ?) "
+            "ON CONFLICT (file_unique_id) DO NOTHING",
+            (item["unique_id"], item["file_id"], item["kind"])
         )
-        await db.commit()
-        async with db.execute("SELECT last_insert_rowid()") as cursor:
-            row = await cursor.fetchone()
-            return row[0]
-
-async def update_task_status(task_id: int, status: str, admin_id: int, admin_username: str):
-    """Обновить статус ТЗ"""
-    async with aiosqlite.connect(DB_PATH) as db:
         await db.execute(
-            """UPDATE tasks SET status = ?, assigned_admin_id = ?, assigned_admin_username = ?, 
-               updated_at = CURRENT_TIMESTAMP WHERE id = ?""",
-            (status, admin_id, admin_username, task_id)
+            "INSERT INTO attachments (entity, item_id, position, media_id) "
+            "SELECT ?, ?, ?, id FROM media_files WHERE file_unique_id = ?",
+            (entity, item_id, position, item["unique_id"])
         )
-        await db.commit()
 
-async def get_task_by_id(task_id: int):
+async def _insert_with_attachments(row_type, entity: str, sql: str, params, media: list) -> NamedTuple:
+    """INSERT ... RETURNING и вложения новой строки одной транзакцией"""
+    async def op(db):
+        cursor = await db.execute(sql, params)
+        row = await cursor.fetchone()
+        await cursor.close()
+        await _store_attachments(db, entity, row[0], media)
+        return row
+    return _typed(row_type, await write_batcher.submit(op))
+
+@metrics.track("db")
+async def known_media(unique_ids: list) -> dict:
+    """Реестр файлов: file_unique_id -> уже сохранённый file_id"""
+    if not unique_ids:
+        return {}
+    async with db_pool.reader() as db:
+        async with db.execute(
+            f"SELECT file_unique_id, file_id FROM media_files "
+            f"WHERE file_unique_id IN ({', '.join('?' * len(unique_ids))})", unique_ids
+        ) as cursor:
+            return dict(await cursor.fetchall())
+
+@metrics.track("db")
+async def get_attachments(entity: str, item_id: int) -> list:
+    """Вложения записи по порядку: [{"file_id", "kind", "unique_id"}]"""
+    async with db_pool.reader() as db:
+        async with db.execute(
+            """SELECT file_id, kind, file_unique_id FROM attachments
+               JOIN media_files ON media_files.id = media_id
+               WHERE entity = ? AND item_id = ? ORDER BY position""",
+            (entity, item_id)
+        ) as cursor:
+            return [{"file_id": file_id, "kind": kind, "unique_id": unique_id}
+                    for file_id, kind, unique_id in await cursor.fetchall()]
+
+# === ФУНКЦИИ ДЛЯ ТЗ ===
+
+@metrics.track("db")
+async def create_task(author_id: int, author_username: str, description: str, media: list = ()) -> TaskRow:
+    """Создать новое ТЗ вместе с вложениями"""
+    return await _insert_with_attachments(
+        TaskRow, "tasks",
+        f"""INSERT INTO tasks (author_id, author_username, description, media_file_id)
+            VALUES (?, ?, ?, ?) RETURNING {TASK_COLUMNS}""",
+        (author_id, author_username, description, _first_file_id(media)), media
+    )
+
+@metrics.track("db")
+async def update_task_status(task_id: int, status: str, admin_id: int, admin_username: str,
+                             version: int = None, notice=None) -> Optional[TaskRow]:
+    """Сменить статус ТЗ и вернуть обновлённую строку (None — ТЗ нет или его уже обработали).
+
+    notice(task) — текст уведомления автору, оно ставится в outbox вместе со сменой статуса.
+    """
+    async def notify(db, task: TaskRow):
+        await enqueue_notification(db, task.author_id, notice(task))
+    return await _transition(TaskRow, "tasks", TASK_COLUMNS, task_id, status, admin_id, admin_username, version,
+                             notify if notice else None)
+
+@metrics.track("db")
+async def get_task_by_id(task_id: int) -> Optional[TaskRow]:
     """Получить ТЗ по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.reader() as db:
         async with db.execute(
-            "SELECT * FROM tasks WHERE id = ?", (task_id,)
+            f"SELECT {TASK_COLUMNS} FROM tasks WHERE id = ?", (task_id,)
         ) as cursor:
-            return await cursor.fetchone()
+            return _typed(TaskRow, await cursor.fetchone())
 
 # === ФУНКЦИИ ДЛЯ БАГОВ ===
 
-async def create_bug(author_id: int, author_username: str, description: str, media_file_id: str = None):
-    """Создать новый баг"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """INSERT INTO bugs (author_id, author_username, description, media_file_id)
-               VALUES (?, ?, ?, ?)""",
-            (author_id, author_username, description, media_file_id)
-        )
-        await db.commit()
-        async with db.execute("SELECT last_insert_rowid()") as cursor:
-            row = await cursor.fetchone()
-            return row[0]
+@metrics.track("db")
+async def create_bug(author_id: int, author_username: str, description: str, media: list = ()) -> BugRow:
+    """Создать новый баг вместе с вложениями"""
+    return await _insert_with_attachments(
+        BugRow, "bugs",
+        f"""INSERT INTO bugs (author_id, author_username, description, media_file_id)
+            VALUES (?, ?, ?, ?) RETURNING {BUG_COLUMNS}""",
+        (author_id, author_username, description, _first_file_id(media)), media
+    )
 
-async def update_bug_status(bug_id: int, status: str, admin_id: int, admin_username: str, message_id_in_group: int = None):
-    """Обновить статус бага"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        if message_id_in_group:
+@metrics.track("db")
+async def update_bug_status(bug_id: int, status: str, admin_id: int, admin_username: str,
+                            version: int = None, notice=None, duplicate_notice=None) -> Optional[BugRow]:
+    """Сменить статус бага и вернуть обновлённую строку (None — бага нет или его уже обработали).
+
+    notice(bug) — уведомление автору, duplicate_notice(bug) — авторам повторных отчётов (через outbox).
+    """
+    async def notify(db, bug: BugRow):
+        if notice:
+            await enqueue_notification(db, bug.author_id, notice(bug))
+        if duplicate_notice and bug.duplicate_count:
             await db.execute(
-                """UPDATE bugs SET status = ?, assigned_admin_id = ?, assigned_admin_username = ?, 
-                   message_id_in_group = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?""",
-                (status, admin_id, admin_username, message_id_in_group, bug_id)
+                """INSERT INTO outbox (chat_id, text, next_attempt_at)
+                   SELECT DISTINCT author_id, ?, ? FROM bugs WHERE duplicate_of = ? AND author_id != ?""",
+                (duplicate_notice(bug), time.time(), bug.id, bug.author_id)
             )
-        else:
-            await db.execute(
-                """UPDATE bugs SET status = ?, assigned_admin_id = ?, assigned_admin_username = ?, 
-                   updated_at = CURRENT_TIMESTAMP WHERE id = ?""",
-                (status, admin_id, admin_username, bug_id)
-            )
-        await db.commit()
+    return await _transition(BugRow, "bugs", BUG_COLUMNS, bug_id, status, admin_id, admin_username, version,
+                             notify if notice or duplicate_notice else None)
 
-async def get_bug_by_id(bug_id: int):
+@metrics.track("db")
+async def get_bug_by_id(bug_id: int) -> Optional[BugRow]:
     """Получить баг по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT * FROM bugs WHERE id = ?", (bug_id,)) as cursor:
-            return await cursor.fetchone()
+    async with db_pool.reader() as db:
+        async with db.execute(f"SELECT {BUG_COLUMNS} FROM bugs WHERE id = ?", (bug_id,)) as cursor:
+            return _typed(BugRow, await cursor.fetchone())
+
+def save_bug_post(bug_id: int, rendered: str, message_id_in_group: int = None) -> asyncio.Future:
+    """Запомнить текст поста бага, который сейчас показан в группе (групповая фиксация)"""
+    if message_id_in_group:
+        return write_batcher.execute(
+            "UPDATE bugs SET post_rendered = ?, message_id_in_group = ? WHERE id = ?",
+            (rendered, message_id_in_group, bug_id)
+        )
+    return write_batcher.execute("UPDATE bugs SET post_rendered = ? WHERE id = ?", (rendered, bug_id))
+
+@metrics.track("db")
+async def create_duplicate_bug(author_id: int, author_username: str, description: str,
+                               media: list, original_id: int) -> Optional[BugRow]:
+    """Записать повторный отчёт и увеличить счётчик исходного бага (одной транзакцией).
+
+    Возвращает исходный баг с новым счётчиком; None — если он уже закрыт.
+    """
+    async def op(db):
+        cursor = await db.execute(
+            f"""UPDATE bugs SET duplicate_count = duplicate_count + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status IN ('pending', 'in_progress') RETURNING {BUG_COLUMNS}""",
+            (original_id,)
+        )
+        row = await cursor.fetchone()
+        await cursor.close()
+        if row is not None:
+            cursor = await db.execute(
+                """INSERT INTO bugs (author_id, author_username, description, media_file_id, status, duplicate_of)
+                   VALUES (?, ?, ?, ?, 'duplicate', ?)""",
+                (author_id, author_username, description, _first_file_id(media), original_id)
+            )
+            await _store_attachments(db, "bugs", cursor.lastrowid, media)
+        return row
+    return _typed(BugRow, await write_batcher.submit(op))
+
+# === ПОВТОРНЫЕ БАГИ ===
+
+class DuplicateIndex:
+    """MinHash/LSH-индекс открытых багов: поиск похожего отчёта без перебора всех багов.
+
+    Текст -> множество шинглов из соседних слов -> подпись из bands*rows минимальных хешей.
+    Подпись режется на полосы; баги с совпавшей полосой — кандидаты, сходство которых
+    оценивается по доле совпавших хешей. Индекс живёт в памяти и прогревается из БД при старте.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, bands: int = DUPLICATE_BANDS, rows: int = DUPLICATE_ROWS,
+                 threshold: float = DUPLICATE_THRESHOLD, shingle: int = DUPLICATE_SHINGLE,
+                 min_shingles: int = DUPLICATE_MIN_SHINGLES, seed: int = 1):
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+        self.shingle = shingle
+        self.min_shingles = min_shingles
+        rng = random.Random(seed)
+        self._hashes = [(rng.randrange(1, self._PRIME), rng.randrange(self._PRIME))
+                        for _ in range(bands * rows)]
+        self._buckets = [{} for _ in range(bands)]  # полоса -> {ключ полосы: set(bug_id)}
+        self._signatures = {}                       # bug_id -> подпись
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def signature(self, text: str) -> Optional[tuple]:
+        """Подпись MinHash; None — слишком короткий отчёт, сравнивать его не с чем"""
+        words = re.findall(r"\w+", text.lower())
+        k = self.shingle
+        shingles = {zlib.crc32(" ".join(words[i:i + k]).encode()) for i in range(len(words) - k + 1)}
+        if len(shingles) < self.min_shingles:
+            return None
+        prime = self._PRIME
+        return tuple(min((a * h + b) % prime for h in shingles) for a, b in self._hashes)
+
+    def _band_keys(self, signature: tuple):
+        rows = self.rows
+        return [signature[i * rows:(i + 1) * rows] for i in range(self.bands)]
+
+    def add(self, bug_id: int, text: str):
+        signature = self.signature(text)
+        if signature is None or bug_id in self._signatures:
+            return
+        self._signatures[bug_id] = signature
+        for buckets, key in zip(self._buckets, self._band_keys(signature)):
+            buckets.setdefault(key, set()).add(bug_id)
+
+    def remove(self, bug_id: int):
+        signature = self._signatures.pop(bug_id, None)
+        if signature is None:
+            return
+        for buckets, key in zip(self._buckets, self._band_keys(signature)):
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket.discard(bug_id)
+                if not bucket:
+                    del buckets[key]
+
+    def find(self, text: str):
+        """Самый похожий открытый баг: (bug_id, сходство) или None"""
+        signature = self.signature(text)
+        if signature is None:
+            return None
+        candidates = set()
+        for buckets, key in zip(self._buckets, self._band_keys(signature)):
+            candidates |= buckets.get(key, set())
+        best = None
+        for bug_id in candidates:
+            other = self._signatures[bug_id]
+            similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (bug_id, similarity)
+        return best
+
+    async def load(self):
+        """Заполнить индекс открытыми исходными багами из БД"""
+        async with db_pool.reader() as db:
+            async with db.execute(
+                "SELECT id, description FROM bugs WHERE status IN ('pending', 'in_progress') "
+                "AND duplicate_of IS NULL"
+            ) as cursor:
+                rows = await cursor.fetchall()
+        for bug_id, description in rows:
+            self.add(bug_id, description)
+        logger.info(f"🔁 Индекс повторных багов: {len(self)} открытых")
+
+duplicate_index = DuplicateIndex()
 
 # === ФУНКЦИИ ДЛЯ ЗАЯВОК ===
 
-async def create_application(user_id: int, username: str, position: str, answers: list):
-    """Создать новую заявку"""
+@metrics.track("db")
+async def create_application(user_id: int, username: str, position: str, answers: list) -> ApplicationRow:
+    """Создать новую заявку и начать отсчёт паузы до следующей"""
     tz, mod_exp, other_proj, cheat_check, grif_exp, age, time_avail = answers
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """INSERT INTO applications
+    app = await _returning(
+        ApplicationRow,
+        f"""INSERT INTO applications
             (user_id, username, position, timezone, moderation_experience, other_projects,
              cheat_check_knowledge, grif_experience, age, available_time)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, username, position, tz, mod_exp, other_proj, cheat_check, grif_exp, age, time_avail)
-        )
-        await db.commit()
-        async with db.execute("SELECT last_insert_rowid()") as cursor:
-            row = await cursor.fetchone()
-            return row[0]
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING {APPLICATION_COLUMNS}""",
+        (user_id, username, position, tz, mod_exp, other_proj, cheat_check, grif_exp, age, time_avail)
+    )
+    application_cooldowns.record(user_id, position, time.time())
+    return app
+
+def cooldown_seconds(position: str) -> float:
+    return APPLICATION_COOLDOWNS.get(position, APPLICATION_COOLDOWN_DEFAULT).total_seconds()
+
+class ApplicationCooldowns:
+    """Пауза между заявками в памяти: user_id -> момент (epoch), с которого можно подать снова"""
+
+    def __init__(self):
+        self._until = {}
+
+    async def load(self):
+        """Прогреть индекс заявками, чья пауза ещё не истекла"""
+        longest = max([cooldown_seconds(p) for p in APPLICATION_COOLDOWNS] + [cooldown_seconds(None)])
+        async with db_pool.reader() as db:
+            async with db.execute(
+                """SELECT user_id, position, CAST(strftime('%s', created_at) AS REAL) FROM applications
+                   WHERE created_at >= datetime('now', ?)""",
+                (f"-{int(longest)} seconds",)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        self._until = {}
+        for user_id, position, created in rows:
+            self.record(user_id, position, created)
+        logger.info(f"✅ Индекс пауз между заявками: {len(self._until)} пользователей")
+
+    def record(self, user_id: int, position: str, created: float):
+        until = created + cooldown_seconds(position)
+        if until > self._until.get(user_id, 0):
+            self._until[user_id] = until
+
+    def remaining(self, user_id: int, now: float = None) -> float:
+        """Сколько секунд ещё ждать (0 — можно подавать)"""
+        until = self._until.get(user_id)
+        if until is None:
+            return 0
+        left = until - (time.time() if now is None else now)
+        if left <= 0:
+            del self._until[user_id]
+            return 0
+        return left
+
+application_cooldowns = ApplicationCooldowns()
+
+def update_application_message_id(app_id: int, message_id: int) -> asyncio.Future:
+    """Обновить ID сообщения заявки в группе (групповая фиксация)"""
+    return write_batcher.execute(
+        "UPDATE applications SET message_id_in_group = ? WHERE id = ?",
+        (message_id, app_id)
+    )
 
-async def get_last_application(user_id: int):
-    """Получить последнюю заявку пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
+@metrics.track("db")
+async def get_application_by_id(app_id: int) -> Optional[ApplicationRow]:
+    """Получить заявку по ID"""
+    async with db_pool.reader() as db:
         async with db.execute(
-            "SELECT * FROM applications WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
-            (user_id,)
+            f"SELECT {APPLICATION_COLUMNS} FROM applications WHERE id = ?", (app_id,)
         ) as cursor:
-            return await cursor.fetchone()
+            return _typed(ApplicationRow, await cursor.fetchone())
+
+@metrics.track("db")
+async def update_application_status(app_id: int, status: str, admin_id: int, admin_username: str,
+                                    version: int = None, notice=None) -> Optional[ApplicationRow]:
+    """Сменить статус заявки и вернуть обновлённую строку (None — заявки нет или её уже рассмотрели).
+
+    notice(app) — текст уведомления автору, оно ставится в outbox вместе со сменой статуса.
+    """
+    async def notify(db, app: ApplicationRow):
+        await enqueue_notification(db, app.user_id, notice(app))
+    return await _transition(
+        ApplicationRow, "applications", APPLICATION_COLUMNS, app_id, status, admin_id, admin_username, version,
+        notify if notice else None
+    )
 
-async def update_application_message_id(app_id: int, message_id: int):
-    """Обновить ID сообщения заявки в группе"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE applications SET message_id_in_group = ? WHERE id = ?",
-            (message_id, app_id)
-        )
-        await db.commit()
+# === СТАТИСТИКА ===
 
-async def get_application_by_id(app_id: int):
-    """Получить заявку по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT * FROM applications WHERE id = ?", (app_id,)) as cursor:
-            return await cursor.fetchone()
+class QueueStats(NamedTuple):
+    counters: dict                   # {(таблица, статус): количество}
+    resolved: list                   # [(admin_id, username, {таблица: решено})], больше решений — выше
 
-async def update_application_status(app_id: int, status: str):
-    """Обновить статус заявки"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE applications SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (status, app_id)
+@metrics.track("db")
+async def get_stats() -> QueueStats:
+    """Снимок счётчиков, которые поддерживают триггеры: размер выборки не зависит от объёма таблиц"""
+    async with db_pool.reader() as db:
+        async with db.execute("SELECT entity, status, count FROM status_counters") as cursor:
+            counters = {(entity, status): count for entity, status, count in await cursor.fetchall()}
+        async with db.execute(
+            """SELECT admin_resolved.admin_id, admins.username, entity, count FROM admin_resolved
+               LEFT JOIN admins ON admins.user_id = admin_resolved.admin_id WHERE count > 0"""
+        ) as cursor:
+            rows = await cursor.fetchall()
+    by_admin = {}
+    for admin_id, username, entity, count in rows:
+        by_admin.setdefault(admin_id, (username or f"ID {admin_id}", {}))[1][entity] = count
+    resolved = sorted(
+        ((admin_id, username, counts) for admin_id, (username, counts) in by_admin.items()),
+        key=lambda item: -sum(item[2].values())
+    )
+    return QueueStats(counters, resolved)
+
+# === СПИСКИ ===
+
+@metrics.track("db")
+async def fetch_page(table: str, statuses: tuple, cursor: int = None, newer: bool = False,
+                     limit: int = LIST_PAGE_SIZE):
+    """Страница записей по статусам с keyset-пагинацией по (status, id).
+
+    Для каждого статуса — отдельный диапазонный запрос по индексу, результаты сливаются,
+    поэтому время выборки не зависит от размера таблицы и номера страницы.
+    Возвращает (строки по убыванию id, есть_новее, есть_старее).
+    """
+    if table not in ("tasks", "bugs"):
+        raise ValueError(f"Неизвестная таблица: {table}")
+    if newer:
+        sql = (f"SELECT id, author_username, description, status FROM {table} "
+               f"WHERE status = ? AND id > ? ORDER BY id ASC LIMIT ?")
+    elif cursor is not None:
+        sql = (f"SELECT id, author_username, description, status FROM {table} "
+               f"WHERE status = ? AND id < ? ORDER BY id DESC LIMIT ?")
+    else:
+        sql = (f"SELECT id, author_username, description, status FROM {table} "
+               f"WHERE status = ? ORDER BY id DESC LIMIT ?")
+
+    rows = []
+    async with db_pool.reader() as db:
+        for status in statuses:
+            params = (status, limit + 1) if cursor is None else (status, cursor, limit + 1)
+            async with db.execute(sql, params) as cur:
+                rows.extend(await cur.fetchall())
+
+    rows.sort(key=lambda row: row[0], reverse=not newer)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if newer:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, cursor is not None, has_more
+
+# === ПОИСК ===
+
+class SearchHit(NamedTuple):
+    kind: str       # таблица: tasks / bugs / applications
+    id: int
+    status: str
+    snippet: str
+    score: float    # bm25: чем меньше, тем релевантнее
+
+def fts_query(text: str) -> Optional[str]:
+    """Текст пользователя -> выражение MATCH без синтаксиса FTS5.
+
+    Все слова обязательны и ищутся как префиксы («вход» найдёт и «входа»); длинные слова
+    обрезаются до SEARCH_PREFIX_MAX символов, чтобы каждое попадало в префиксный индекс.
+    """
+    words = [w[:SEARCH_PREFIX_MAX] for w in re.findall(r"\w+", text.lower()) if len(w) > 1]
+    return " ".join(f'"{word}"*' for word in words[:SEARCH_MAX_TERMS]) or None
+
+@metrics.track("db")
+async def search(text: str, limit: int = SEARCH_MAX_RESULTS) -> list:
+    """Лучшие по bm25 совпадения в ТЗ, багах и заявках.
+
+    Ранжируются SEARCH_CANDIDATES самых свежих совпадений каждой таблицы (для редких слов —
+    все), так что время не растёт с размером таблицы даже для слов, которые есть почти везде.
+    Сниппеты строятся только для попавших в выдачу строк.
+    """
+    match = fts_query(text)
+    if not match:
+        return []
+    ranked = []
+    async with db_pool.reader() as db:
+        for table in SEARCH_COLUMNS:
+            sql = f"""SELECT f.id, t.status, f.score FROM (
+                    SELECT id, score FROM (
+                        SELECT rowid AS id, bm25({table}_fts) AS score FROM {table}_fts
+                        WHERE {table}_fts MATCH ? ORDER BY rowid DESC LIMIT ?
+                    ) ORDER BY score LIMIT ?
+                ) AS f JOIN {table} AS t ON t.id = f.id"""
+            async with db.execute(sql, (match, SEARCH_CANDIDATES, limit)) as cursor:
+                ranked.extend((score, table, item_id, status) for item_id, status, score in await cursor.fetchall())
+        ranked.sort()
+        ranked = ranked[:limit]
+
+        snippets = {}
+        for table in SEARCH_COLUMNS:
+            ids = [item_id for _, kind, item_id, _ in ranked if kind == table]
+            if not ids:
+                continue
+            sql = (f"SELECT rowid, snippet({table}_fts, -1, '«', '»', '…', 12) FROM {table}_fts "
+                   f"WHERE {table}_fts MATCH ? AND rowid IN ({', '.join('?' * len(ids))})")
+            async with db.execute(sql, (match, *ids)) as cursor:
+                snippets.update(((table, item_id), snippet) for item_id, snippet in await cursor.fetchall())
+
+    return [SearchHit(table, item_id, status, snippets.get((table, item_id), ""), score)
+            for score, table, item_id, status in ranked]
+
+# === FSM-СЕССИИ ===
+
+class SessionStore:
+    """Хранилище FSM-сессий: LRU+TTL в памяти и отложенная запись в SQLite.
+
+    У пользователя одна активная сессия; flow — её тип: task, bug, application или admin.
+    """
+
+    def __init__(self, ttl: int = SESSION_TTL, max_entries: int = SESSION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # user_id -> (flow, data, expires_at)
+        # user_id -> (flow, data, expires_at), None (удаление) или flow (удаление сессии только этого типа)
+        self._dirty = {}
+
+    def _evict(self):
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id: int, flow: str = None):
+        """Данные сессии пользователя (если flow задан — только сессии этого типа)"""
+        entry = self._cache.get(user_id)
+        if entry is None:
+            pending = self._dirty.get(user_id, ())
+            if pending is None or isinstance(pending, tuple) and pending:
+                entry = pending
+            else:
+                async with db_pool.reader() as db:
+                    async with db.execute(
+                        "SELECT flow, data, expires_at FROM fsm_sessions WHERE user_id = ?", (user_id,)
+                    ) as cursor:
+                        row = await cursor.fetchone()
+                # Удаление сессии этого типа ещё не записано в БД
+                if row and row[0] != pending:
+                    entry = (row[0], json.loads(row[1]), row[2])
+            if entry is None:
+                return None
+        if entry[2] < time.time():
+            self.drop(user_id)
+            return None
+        self._cache[user_id] = entry
+        self._cache.move_to_end(user_id)
+        self._evict()
+        if flow is not None and entry[0] != flow:
+            return None
+        return entry[1]
+
+    async def get_flow(self, user_id: int):
+        """Тип активной сессии пользователя и её данные"""
+        data = await self.get(user_id)
+        if data is None:
+            return None, None
+        return self._cache[user_id][0], data
+
+    def put(self, user_id: int, flow: str, data: dict):
+        """Сохранить сессию (запись в БД произойдёт при ближайшем flush)"""
+        entry = (flow, data, time.time() + self.ttl)
+        self._cache[user_id] = entry
+        self._cache.move_to_end(user_id)
+        self._dirty[user_id] = entry
+        self._evict()
+
+    def drop(self, user_id: int, flow: str = None):
+        """Удалить сессию (если flow задан — только сессию этого типа)"""
+        entry = self._cache.get(user_id)
+        if entry is None:
+            pending = self._dirty.get(user_id)
+            entry = pending if isinstance(pending, tuple) else None
+        if flow is not None and entry is not None and entry[0] != flow:
+            return
+        self._cache.pop(user_id, None)
+        if flow is None or entry is not None or self._dirty.get(user_id, ()) is None:
+            self._dirty[user_id] = None
+        else:
+            # Сессии нет в памяти: её тип знает только БД, удаляем с условием на flow
+            self._dirty[user_id] = flow
+
+    @metrics.track("db", "sessions_flush")
+    @retry_on_lock
+    async def flush(self):
+        """Записать накопленные изменения в БД одной транзакцией"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        upserts = [
+            (user_id, entry[0], json.dumps(entry[1], ensure_ascii=False), entry[2])
+            for user_id, entry in dirty.items() if isinstance(entry, tuple)
+        ]
+        deletes = [(user_id,) for user_id, entry in dirty.items() if entry is None]
+        flow_deletes = [(user_id, entry) for user_id, entry in dirty.items() if isinstance(entry, str)]
+        try:
+            async with db_pool.writer() as db:
+                if upserts:
+                    await db.executemany(
+                        """INSERT INTO fsm_sessions (user_id, flow, data, expires_at) VALUES (?, ?, ?, ?)
+                           ON CONFLICT(user_id) DO UPDATE SET
+                           flow = excluded.flow, data = excluded.data, expires_at = excluded.expires_at""",
+                        upserts
+                    )
+                if deletes:
+                    await db.executemany("DELETE FROM fsm_sessions WHERE user_id = ?", deletes)
+                if flow_deletes:
+                    await db.executemany("DELETE FROM fsm_sessions WHERE user_id = ? AND flow = ?", flow_deletes)
+        except Exception:
+            # Вернём несохранённые изменения, не затирая более свежие
+            for user_id, entry in dirty.items():
+                self._dirty.setdefault(user_id, entry)
+            raise
+
+    @retry_on_lock
+    async def purge_expired(self):
+        """Удалить просроченные сессии из памяти и БД"""
+        now = time.time()
+        for user_id in [uid for uid, entry in self._cache.items() if entry[2] < now]:
+            del self._cache[user_id]
+        async with db_pool.writer() as db:
+            await db.execute("DELETE FROM fsm_sessions WHERE expires_at < ?", (now,))
+
+sessions = SessionStore()
+
+async def checkpoint_wal(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодический чекпоинт WAL, чтобы журнал не разрастался"""
+    try:
+        busy, log_pages, checkpointed = await db_pool.checkpoint()
+        if busy:
+            logger.info(f"Чекпоинт WAL частичный: {checkpointed}/{log_pages} страниц")
+    except Exception as e:
+        logger.error(f"Не удалось выполнить чекпоинт WAL: {e}")
+
+async def flush_sessions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая запись FSM-сессий в БД"""
+    try:
+        await sessions.flush()
+    except Exception as e:
+        logger.error(f"Не удалось сохранить сессии: {e}")
+
+async def purge_sessions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая очистка просроченных сессий"""
+    try:
+        await sessions.purge_expired()
+    except Exception as e:
+        logger.error(f"Не удалось очистить сессии: {e}")
+
+# === ОТПРАВКА СООБЩЕНИЙ ===
+
+# Классы приоритета исходящих запросов (меньше — важнее)
+PRIORITY_EDIT = 0      # правка статуса админом
+PRIORITY_POST = 1      # новые посты в группу/админам, ответы пользователю
+PRIORITY_NOTIFY = 2    # уведомления авторам
+PRIORITY_BROADCAST = 3 # рассылка /broadcast: забирает только свободную часть глобального лимита
+
+# Запросы, которые можно слить, если правка того же сообщения ещё в очереди
+COALESCED_ENDPOINTS = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup"}
+
+class TokenBucket:
+    """Ведро токенов"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Сколько секунд ждать до появления токена (0 — можно отправлять)"""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def penalize(self, seconds: float):
+        """Запретить отправку на указанное время (после RetryAfter)"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+class FloodLimiter:
+    """Глобальный и початовый лимиты Telegram"""
+
+    MAX_IDLE_BUCKETS = 1000
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chats = {}
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_BUCKETS:
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_idle()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = TELEGRAM_GROUP_RATE if is_group else TELEGRAM_PRIVATE_RATE
+            bucket = self._chats[chat_id] = TokenBucket(rate, 1)
+        return bucket
+
+    def penalize(self, chat_id, seconds: float):
+        self.chat_bucket(chat_id).penalize(seconds)
+
+class OutboundJob:
+    """Исходящий запрос в очереди планировщика"""
+
+    __slots__ = ("priority", "seq", "chat_id", "thread_id", "endpoint", "coalesce_key",
+                 "callback", "args", "kwargs", "future", "attempts", "enqueued")
+
+    def __init__(self, priority, seq, chat_id, thread_id, endpoint, coalesce_key, callback, args, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.thread_id = thread_id
+        self.endpoint = endpoint
+        self.coalesce_key = coalesce_key
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+        self.enqueued = 0.0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundScheduler(BaseRateLimiter):
+    """Единая очередь исходящих запросов к Bot API: лимиты по чатам, приоритеты, слияние правок"""
+
+    def __init__(self, limiter: FloodLimiter, max_in_flight: int = OUTBOUND_MAX_IN_FLIGHT,
+                 max_attempts: int = FANOUT_MAX_ATTEMPTS):
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self._max_in_flight = max_in_flight
+        self._queues = {}          # chat_id -> куча OutboundJob
+        self._pending_edits = {}   # (chat_id, message_id, endpoint) -> OutboundJob
+        self._seq = 0
+        self._size = 0
+        self._wakeup = None
+        self._slots = None
+        self._dispatcher = None
+        self.coalesced = 0
+
+    async def initialize(self) -> None:
+        if self._dispatcher is not None:
+            return  # Application и Updater инициализируют бота (и планировщик) каждый по разу
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self._max_in_flight)
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for heap in self._queues.values():
+            for job in heap:
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError("Планировщик отправки остановлен"))
+        self._queues.clear()
+        self._pending_edits.clear()
+        self._size = 0
+
+    def depth(self) -> dict:
+        """Глубина очереди по классам приоритета"""
+        result = {PRIORITY_EDIT: 0, PRIORITY_POST: 0, PRIORITY_NOTIFY: 0, PRIORITY_BROADCAST: 0}
+        for heap in self._queues.values():
+            for job in heap:
+                result[job.priority] = result.get(job.priority, 0) + 1
+        return result
+
+    def depth_by_chat(self) -> dict:
+        """Глубина очереди по чатам/темам"""
+        result = {}
+        for heap in self._queues.values():
+            for job in heap:
+                key = (job.chat_id, job.thread_id)
+                result[key] = result.get(key, 0) + 1
+        return result
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._dispatcher is None:
+            # Запросы без чата (answerCallbackQuery, getMe, ...) не ставим в очередь
+            return await self._call_direct(callback, args, kwargs, endpoint)
+
+        coalesce_key = None
+        if endpoint in COALESCED_ENDPOINTS and data.get("message_id"):
+            coalesce_key = (chat_id, data["message_id"], endpoint)
+            pending = self._pending_edits.get(coalesce_key)
+            if pending is not None:
+                # Правка того же сообщения ещё не ушла — отправим только последнюю версию
+                pending.callback, pending.args, pending.kwargs = callback, args, kwargs
+                self.coalesced += 1
+                return await asyncio.shield(pending.future)
+
+        if rate_limit_args and "priority" in rate_limit_args:
+            priority = rate_limit_args["priority"]
+        elif endpoint.startswith("edit"):
+            priority = PRIORITY_EDIT
+        else:
+            priority = PRIORITY_POST
+
+        self._seq += 1
+        job = OutboundJob(priority, self._seq, chat_id, data.get("message_thread_id"),
+                          endpoint, coalesce_key, callback, args, kwargs)
+        if coalesce_key:
+            self._pending_edits[coalesce_key] = job
+        self._push(job)
+        return await asyncio.shield(job.future)
+
+    async def _call_direct(self, callback, args, kwargs, endpoint):
+        """Запрос мимо очереди; на RetryAfter — пауза и повтор, чтобы 429 не обрывал обработчик"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await metrics.measure("api", endpoint, callback(*args, **kwargs))
+            except RetryAfter as e:
+                if attempt == self.max_attempts:
+                    raise
+                logger.warning(f"Flood control для {endpoint}: ждём {e.retry_after} с")
+                await asyncio.sleep(float(e.retry_after))
+
+    def _push(self, job: OutboundJob):
+        job.enqueued = time.perf_counter()
+        heapq.heappush(self._queues.setdefault(job.chat_id, []), job)
+        self._size += 1
+        self._wakeup.set()
+
+    def _pick(self):
+        """Выбрать самый приоритетный запрос среди чатов, у которых есть токен"""
+        global_wait = self.limiter.global_bucket.wait_time()
+        if global_wait > 0:
+            return None, global_wait
+        best = None
+        min_wait = None
+        for chat_id, heap in self._queues.items():
+            wait = self.limiter.chat_bucket(chat_id).wait_time()
+            if wait > 0:
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+            elif best is None or heap[0] < best[0]:
+                best = heap[0], chat_id
+        if best is None:
+            return None, min_wait
+        job, chat_id = best
+        heap = self._queues[chat_id]
+        heapq.heappop(heap)
+        if not heap:
+            del self._queues[chat_id]
+        self._size -= 1
+        if job.coalesce_key and self._pending_edits.get(job.coalesce_key) is job:
+            del self._pending_edits[job.coalesce_key]
+        self.limiter.global_bucket.take()
+        self.limiter.chat_bucket(chat_id).take()
+        if metrics.enabled:
+            metrics.observe("api_wait", job.endpoint, time.perf_counter() - job.enqueued)
+        return job, 0
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._slots.acquire()
+            job, delay = self._pick()
+            if job is None:
+                self._slots.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            spawn(self._execute(job))
+
+    async def _execute(self, job: OutboundJob):
+        try:
+            result = await metrics.measure("api", job.endpoint, job.callback(*job.args, **job.kwargs))
+        except RetryAfter as e:
+            job.attempts += 1
+            logger.warning(f"Flood control для {job.chat_id}: ждём {e.retry_after} с")
+            self.limiter.penalize(job.chat_id, float(e.retry_after))
+            if job.attempts < self.max_attempts:
+                self._push(job)
+            elif not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._slots.release()
+
+flood_limiter = FloodLimiter()
+outbound = OutboundScheduler(flood_limiter)
+
+_background_tasks = set()
+
+def spawn(coro):
+    """Запустить фоновую задачу, сохранив ссылку на неё до завершения"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+class FanOutDelivery:
+    """Ход рассылки: первая успешная доставка и итоговые результаты по получателям"""
+
+    def __init__(self, recipients):
+        self.recipients = list(recipients)
+        self.results = {}  # chat_id -> True | Exception
+        self._first_success = asyncio.get_running_loop().create_future()
+        self._task = None
+
+    def _record(self, chat_id: int, result):
+        self.results[chat_id] = result
+        if result is True and not self._first_success.done():
+            self._first_success.set_result(True)
+
+    def _finish(self):
+        if not self._first_success.done():
+            self._first_success.set_result(False)
+
+    async def first_success(self) -> bool:
+        """Дождаться первой успешной доставки (False, если не доставлено никому)"""
+        return await asyncio.shield(self._first_success)
+
+    async def wait(self) -> dict:
+        """Дождаться окончания рассылки и вернуть результаты"""
+        await asyncio.shield(self._task)
+        return self.results
+
+    @property
+    def delivered(self) -> int:
+        return sum(1 for r in self.results.values() if r is True)
+
+async def _deliver_one(chat_id: int, send) -> object:
+    """Доставить одному получателю (лимиты и RetryAfter обрабатывает планировщик отправки)"""
+    for attempt in range(1, FANOUT_MAX_ATTEMPTS + 1):
+        try:
+            await send(chat_id)
+            return True
+        except BadRequest as e:
+            # Подкласс NetworkError, но повтор не поможет: чат не найден, неверный file_id, разметка
+            return e
+        except NetworkError as e:
+            error = e
+            if attempt < FANOUT_MAX_ATTEMPTS:
+                await asyncio.sleep(attempt)
+        except Exception as e:
+            return e
+    return error
+
+def fan_out(recipients, send, concurrency: int = FANOUT_CONCURRENCY) -> FanOutDelivery:
+    """Разослать сообщение получателям параллельно (не более concurrency одновременно)"""
+    delivery = FanOutDelivery(recipients)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(chat_id: int):
+        async with semaphore:
+            delivery._record(chat_id, await _deliver_one(chat_id, send))
+
+    async def run():
+        try:
+            await asyncio.gather(*(worker(chat_id) for chat_id in delivery.recipients))
+        finally:
+            delivery._finish()
+
+    delivery._task = spawn(run())
+    return delivery
+
+# === ОЧЕРЕДЬ УВЕДОМЛЕНИЙ ===
+
+async def enqueue_notification(db, chat_id: int, text: str):
+    """Поставить уведомление в outbox внутри текущей транзакции записи"""
+    await db.execute("INSERT INTO outbox (chat_id, text, next_attempt_at) VALUES (?, ?, ?)",
+                     (chat_id, text, time.time()))
+
+class OutboxWorker:
+    """Фоновая доставка уведомлений из outbox: ограниченная параллельность, повторы с паузой, «мёртвые» письма"""
+
+    def __init__(self, concurrency: int = OUTBOX_CONCURRENCY, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 backoff: float = OUTBOX_BACKOFF, poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self._bot = None
+        self._task = None
+        self._wakeup = None
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+
+    def start(self, bot):
+        if self._task is not None:
+            return
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить доставку; недоставленное останется в outbox до следующего запуска"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def wake(self):
+        """Новое уведомление зафиксировано — разбудить доставку, не дожидаясь опроса"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _claim(self) -> list:
+        """Забрать готовые к отправке уведомления, отложив их на OUTBOX_LEASE до итога доставки"""
+        async def op(db):
+            now = time.time()
+            async with db.execute(
+                """SELECT id, chat_id, text, attempts FROM outbox
+                   WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?""",
+                (now, OUTBOX_BATCH)
+            ) as cursor:
+                rows = await cursor.fetchall()
+            # Если итог доставки не запишется, уведомление вернётся в очередь только после аренды
+            await db.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                                 [(now + OUTBOX_LEASE, row[0]) for row in rows])
+            return rows
+        return await write_batcher.submit(op)
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(row):
+            async with semaphore:
+                await self._deliver(*row)
+
+        while True:
+            self._wakeup.clear()
+            try:
+                rows = await self._claim()
+            except Exception as e:
+                logger.error(f"Не удалось прочитать очередь уведомлений: {e}")
+                rows = []
+            if rows:
+                results = await asyncio.gather(*(deliver(row) for row in rows), return_exceptions=True)
+                failures = [r for r in results if isinstance(r, Exception)]
+                if not failures:
+                    continue
+                # Итог доставки не записался — не крутим очередь вхолостую, ждём опроса
+                logger.error(f"Не удалось записать итог доставки {len(failures)} уведомлений: {failures[0]}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, outbox_id: int, chat_id: int, text: str, attempts: int):
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text, rate_limit_args={"priority": PRIORITY_NOTIFY})
+        except Exception as e:
+            attempts += 1
+            # Заблокированный бот или несуществующий чат повтором не исправить
+            permanent = isinstance(e, (Forbidden, BadRequest))
+            if permanent or attempts >= self.max_attempts:
+                self.dead += 1
+                logger.warning(f"☠️ Уведомление {outbox_id} для {chat_id} не доставлено: {e}")
+                await write_batcher.execute(
+                    "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts, str(e), outbox_id)
+                )
+            else:
+                self.retried += 1
+                await write_batcher.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    (attempts, time.time() + self.backoff * 2 ** (attempts - 1), str(e), outbox_id)
+                )
+            return
+        self.sent += 1
+        await write_batcher.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+
+    @metrics.track("db", "outbox_stats")
+    async def stats(self) -> dict:
+        """Сколько уведомлений ждёт доставки и сколько «мёртвых»"""
+        async with db_pool.reader() as db:
+            async with db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status") as cursor:
+                return dict(await cursor.fetchall())
+
+outbox = OutboxWorker()
+
+# === РАССЫЛКА ===
+
+class UserRegistry:
+    """Пользователи, писавшие боту в личку, — получатели /broadcast"""
+
+    def __init__(self):
+        self._known = set()  # user_id, уже записанные в bot_users с момента запуска
+
+    async def track(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработчик группы 1: записать пользователя при первом обновлении от него после запуска"""
+        user, chat = update.effective_user, update.effective_chat
+        if user is None or chat is None or chat.type != chat.PRIVATE or user.id in self._known:
+            return
+        self._known.add(user.id)
+        try:
+            await write_batcher.execute(
+                """INSERT INTO bot_users (user_id, username) VALUES (?, ?)
+                   ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, blocked = 0""",
+                (user.id, user.username)
+            )
+        except Exception as e:
+            self._known.discard(user.id)
+            logger.error(f"Не удалось записать пользователя {user.id}: {e}")
+
+    def forget(self, user_ids):
+        """Бот заблокирован: при следующем обращении пользователь снова станет получателем"""
+        self._known.difference_update(user_ids)
+
+user_registry = UserRegistry()
+
+@metrics.track("db")
+async def count_recipients() -> int:
+    async with db_pool.reader() as db:
+        async with db.execute("SELECT COUNT(*) FROM bot_users WHERE blocked = 0") as cursor:
+            return (await cursor.fetchone())[0]
+
+async def iter_recipients(after: int = 0, page: int = BROADCAST_PAGE):
+    """Получатели страницами по ключу user_id: в памяти не больше одной страницы"""
+    while True:
+        async with db_pool.reader() as db:
+            async with db.execute(
+                "SELECT user_id FROM bot_users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?",
+                (after, page)
+            ) as cursor:
+                user_ids = [row[0] for row in await cursor.fetchall()]
+        if not user_ids:
+            return
+        yield user_ids
+        after = user_ids[-1]
+
+def render_broadcast(row: BroadcastRow) -> str:
+    state = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}[row.status]
+    done = row.sent + row.blocked + row.failed
+    return (f"📣 Рассылка #{row.id} {state}: {done} из {max(done, row.total)}\n"
+            f"✅ Доставлено: {row.sent}\n🚫 Бот заблокирован: {row.blocked}\n❌ Ошибок: {row.failed}")
+
+class Broadcaster:
+    """Рассылка всем пользователям бота.
+
+    Получатели читаются страницами, сообщения идут с самым низким приоритетом через общую очередь
+    отправки (она и держит глобальный лимит Telegram). После каждой страницы счётчики и
+    last_user_id фиксируются в broadcasts, поэтому после перезапуска рассылка продолжается с
+    контрольной точки, а повторно получить сообщение может не больше одной страницы.
+    """
+
+    def __init__(self, page: int = BROADCAST_PAGE, progress_interval: float = BROADCAST_PROGRESS_INTERVAL):
+        self.page = page
+        self.progress_interval = progress_interval
+        self._tasks = {}        # broadcast_id -> asyncio.Task
+        self._cancelled = set()
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self, bot, author_id: int, text: str, chat_id: int) -> BroadcastRow:
+        """Записать рассылку и запустить её; ход показывается в отдельном сообщении в chat_id"""
+        row = await _returning(
+            BroadcastRow,
+            f"INSERT INTO broadcasts (author_id, text, total, progress_chat_id) VALUES (?, ?, ?, ?) "
+            f"RETURNING {BROADCAST_COLUMNS}",
+            (author_id, text, await count_recipients(), chat_id)
         )
-        await db.commit()
+        message = await bot.send_message(chat_id=chat_id, text=render_broadcast(row),
+                                         reply_markup=self._keyboard(row))
+        row = row._replace(progress_message_id=message.message_id)
+        await write_batcher.execute("UPDATE broadcasts SET progress_message_id = ? WHERE id = ?",
+                                    (message.message_id, row.id))
+        self._launch(bot, row)
+        return row
+
+    async def resume(self, bot):
+        """Продолжить рассылки, прерванные остановкой бота"""
+        async with db_pool.reader() as db:
+            async with db.execute(
+                f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running'"
+            ) as cursor:
+                rows = [BroadcastRow(*row) for row in await cursor.fetchall()]
+        for row in rows:
+            logger.info(f"📣 Рассылка #{row.id} продолжается с user_id > {row.last_user_id}")
+            self._launch(bot, row)
+
+    def cancel(self, broadcast_id: int) -> bool:
+        """Остановить рассылку после текущей страницы"""
+        if broadcast_id not in self._tasks:
+            return False
+        self._cancelled.add(broadcast_id)
+        return True
+
+    async def stop(self):
+        """Прервать рассылки при остановке бота; отправленное до этого попадёт в контрольную точку"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _launch(self, bot, row: BroadcastRow):
+        task = asyncio.create_task(self._run(bot, row))
+        self._tasks[row.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(row.id, None))
+
+    @staticmethod
+    def _keyboard(row: BroadcastRow) -> Optional[InlineKeyboardMarkup]:
+        if row.status != "running":
+            return None
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton("⏹ Остановить", callback_data=encode_callback("broadcast", "stop", row.id))
+        ]])
+
+    async def _show(self, bot, row: BroadcastRow):
+        if not row.progress_message_id:
+            return
+        try:
+            await bot.edit_message_text(chat_id=row.progress_chat_id, message_id=row.progress_message_id,
+                                        text=render_broadcast(row), reply_markup=self._keyboard(row))
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                logger.warning(f"Не удалось обновить ход рассылки #{row.id}: {e}")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить ход рассылки #{row.id}: {e}")
+
+    @staticmethod
+    async def _checkpoint(row: BroadcastRow, unreachable: list):
+        """Счётчики, контрольная точка и недоступные получатели — одной транзакцией"""
+        async def op(db):
+            if unreachable:
+                await db.executemany("UPDATE bot_users SET blocked = 1 WHERE user_id = ?",
+                                     [(user_id,) for user_id in unreachable])
+            await db.execute(
+                """UPDATE broadcasts SET status = ?, last_user_id = ?, sent = ?, blocked = ?, failed = ?,
+                   finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END WHERE id = ?""",
+                (row.status, row.last_user_id, row.sent, row.blocked, row.failed, row.status, row.id)
+            )
+        await write_batcher.submit(op)
+        user_registry.forget(unreachable)
+
+    @staticmethod
+    def _tally(row: BroadcastRow, user_ids: list, results: list, unreachable: list) -> BroadcastRow:
+        sent, blocked, failed = row.sent, row.blocked, row.failed
+        for user_id, result in zip(user_ids, results):
+            if result is True:
+                sent += 1
+            elif isinstance(result, (Forbidden, BadRequest)):
+                blocked += 1
+                unreachable.append(user_id)
+            else:
+                failed += 1
+        return row._replace(sent=sent, blocked=blocked, failed=failed,
+                            last_user_id=user_ids[-1] if user_ids else row.last_user_id)
+
+    async def _run(self, bot, row: BroadcastRow):
+        async def send(chat_id: int):
+            await bot.send_message(chat_id=chat_id, text=row.text,
+                                   rate_limit_args={"priority": PRIORITY_BROADCAST})
+
+        shown = time.monotonic()
+        try:
+            async for user_ids in iter_recipients(row.last_user_id, self.page):
+                if row.id in self._cancelled:
+                    break
+                deliveries = [asyncio.ensure_future(_deliver_one(user_id, send)) for user_id in user_ids]
+                try:
+                    await asyncio.gather(*deliveries)
+                except asyncio.CancelledError:
+                    # Остановка бота: в контрольную точку идёт сплошной начальный отрезок доставленного
+                    for delivery in deliveries:
+                        delivery.cancel()
+                    finished = 0
+                    while finished < len(deliveries) and deliveries[finished].done() \
+                            and not deliveries[finished].cancelled():
+                        finished += 1
+                    unreachable = []
+                    row = self._tally(row, user_ids[:finished], [d.result() for d in deliveries[:finished]],
+                                      unreachable)
+                    await self._checkpoint(row, unreachable)
+                    await self._show(bot, row)
+                    raise
+                unreachable = []
+                row = self._tally(row, user_ids, [d.result() for d in deliveries], unreachable)
+                await self._checkpoint(row, unreachable)
+                if time.monotonic() - shown >= self.progress_interval:
+                    shown = time.monotonic()
+                    await self._show(bot, row)
+            row = row._replace(status="cancelled" if row.id in self._cancelled else "done")
+            await self._checkpoint(row, [])
+            logger.info(f"📣 Рассылка #{row.id}: доставлено {row.sent}, бот заблокирован {row.blocked}, "
+                        f"ошибок {row.failed}")
+            await self._show(bot, row)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Рассылка #{row.id} прервана: {e}")
+        finally:
+            self._cancelled.discard(row.id)
+
+broadcaster = Broadcaster()
+
+# === СВОДКИ ДЛЯ АДМИНОВ ===
+
+class DigestItem(NamedTuple):
+    id: int
+    author_username: str
+    description: str
+    media_file_id: Optional[str]
+    status: str
+    version: int
+
+def render_digest(items: list):
+    """Текст сводки и кнопки: по строке «выполнить/отклонить» на каждое ТЗ"""
+    lines = [f"📬 Сводка новых ТЗ: {len(items)}"]
+    keyboard = []
+    for item in items:
+        description = item.description
+        if len(description) > DIGEST_PREVIEW_CHARS:
+            description = description[:DIGEST_PREVIEW_CHARS - 1] + "…"
+        attachment = " 📎" if item.media_file_id else ""
+        lines.append(f"\n📄 #{item.id} от {item.author_username}{attachment}:\n{description}")
+        keyboard.append([
+            InlineKeyboardButton(f"✅ #{item.id}",
+                                 callback_data=encode_callback("task", "complete", item.id, item.version)),
+            InlineKeyboardButton(f"❌ #{item.id}",
+                                 callback_data=encode_callback("task", "reject", item.id, item.version))
+        ])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+class DigestQueue:
+    """Новые ТЗ для админов в режиме сводки: вместо сообщения на каждое ТЗ — одно на пачку.
+
+    Очередь хранится в digest_queue; сводку отправляет job_queue раз в DIGEST_INTERVAL
+    или сразу, как только у админа накопилось max_items ТЗ.
+    """
+
+    def __init__(self, max_items: int = DIGEST_MAX_ITEMS):
+        self.max_items = max_items
+        self._pending = {}      # admin_id -> ТЗ в очереди
+        self._flushing = set()
+        self.sent = 0
+
+    async def load(self):
+        async with db_pool.reader() as db:
+            async with db.execute("SELECT admin_id, COUNT(*) FROM digest_queue GROUP BY admin_id") as cursor:
+                self._pending = dict(await cursor.fetchall())
+
+    async def add(self, task_id: int, admin_ids: list) -> list:
+        """Поставить ТЗ в очередь админов; вернуть тех, у кого набралась полная сводка"""
+        if not admin_ids:
+            return []
+
+        async def op(db):
+            await db.executemany("INSERT OR IGNORE INTO digest_queue (admin_id, task_id) VALUES (?, ?)",
+                                 [(admin_id, task_id) for admin_id in admin_ids])
+        await write_batcher.submit(op)
+        full = []
+        for admin_id in admin_ids:
+            self._pending[admin_id] = self._pending.get(admin_id, 0) + 1
+            if self._pending[admin_id] % self.max_items == 0:
+                full.append(admin_id)
+        return full
+
+    @metrics.track("db", "digests.pending")
+    async def _take(self, admin_id: int) -> list:
+        async with db_pool.reader() as db:
+            async with db.execute(
+                """SELECT tasks.id, tasks.author_username, tasks.description, tasks.media_file_id,
+                          tasks.status, tasks.version
+                   FROM digest_queue JOIN tasks ON tasks.id = digest_queue.task_id
+                   WHERE digest_queue.admin_id = ? ORDER BY digest_queue.task_id LIMIT ?""",
+                (admin_id, self.max_items)
+            ) as cursor:
+                return [DigestItem(*row) for row in await cursor.fetchall()]
+
+    async def flush(self, bot, admin_id: int):
+        """Отправить админу всё накопленное; уже решённые другими админами ТЗ в сводку не попадают"""
+        if admin_id in self._flushing:
+            return
+        self._flushing.add(admin_id)
+        try:
+            while True:
+                items = await self._take(admin_id)
+                if not items:
+                    break
+                still_open = [item for item in items if item.status in STATUS_TRANSITIONS["tasks"]]
+                if still_open:
+                    text, reply_markup = render_digest(still_open)
+                    try:
+                        await bot.send_message(chat_id=admin_id, text=text, reply_markup=reply_markup)
+                    except (Forbidden, BadRequest) as e:
+                        # Повтор не поможет: очередь админа сбрасываем, новые ТЗ пойдут ему по одному
+                        logger.warning(f"⚠️ Сводка админу {admin_id} не доставлена ({e}) — очередь сброшена, "
+                                       f"режим уведомлений переключён на «сразу»")
+                        await write_batcher.execute("DELETE FROM digest_queue WHERE admin_id = ?", (admin_id,))
+                        self._pending.pop(admin_id, None)
+                        await set_notify_mode(admin_id, False)
+                        break
+                    self.sent += 1
+                await write_batcher.execute(
+                    f"DELETE FROM digest_queue WHERE admin_id = ? AND task_id IN ({', '.join('?' * len(items))})",
+                    (admin_id, *(item.id for item in items))
+                )
+                left = self._pending.get(admin_id, 0) - len(items)
+                if left > 0:
+                    self._pending[admin_id] = left
+                else:
+                    self._pending.pop(admin_id, None)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сводку админу {admin_id}: {e}")
+        finally:
+            self._flushing.discard(admin_id)
+
+    @property
+    def queued(self) -> int:
+        return sum(self._pending.values())
+
+    async def flush_all(self, bot):
+        for admin_id in list(self._pending):
+            await self.flush(bot, admin_id)
+
+digests = DigestQueue()
+
+async def flush_digests(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Плановая отправка сводок всем админам с накопленными ТЗ"""
+    await digests.flush_all(context.bot)
+
+async def flush_digest(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Внеплановая сводка одному админу (context.job.data — его user_id)"""
+    await digests.flush(context.bot, context.job.data)
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
+# Компактный формат callback_data: <версия формата><сущность><действие><id в base36>[.<версия записи>]
+# Например, "1tc2n" — выполнить ТЗ #95. Всегда намного короче лимита Telegram в 64 байта.
+CALLBACK_FORMAT_VERSION = "1"
+CALLBACK_ENTITIES = {
+    "t": "task", "b": "bug", "a": "application", "T": "task_list", "B": "bug_list", "S": "search",
+    "m": "broadcast",
+}
+_LIST_ACTIONS = {
+    "a": "active", "c": "completed", "r": "rejected",
+    "A": "active:newer", "C": "completed:newer", "R": "rejected:newer",
+}
+CALLBACK_ACTIONS = {
+    "task": {"c": "complete", "r": "reject"},
+    "bug": {"c": "complete", "p": "progress", "r": "reject"},
+    "application": {"a": "approve", "r": "reject"},
+    "task_list": _LIST_ACTIONS,
+    "bug_list": _LIST_ACTIONS,
+    "search": {"p": "page"},
+    "broadcast": {"s": "stop"},
+}
+_ENTITY_CODES = {name: code for code, name in CALLBACK_ENTITIES.items()}
+_ACTION_CODES = {
+    entity: {name: code for code, name in actions.items()} for entity, actions in CALLBACK_ACTIONS.items()
+}
+# Старый формат кнопок, которые ещё висят в группе и у админов: префикс -> (сущность, действие)
+LEGACY_CALLBACK_PREFIXES = {
+    "complete_": ("task", "complete"),
+    "reject_": ("task", "reject"),
+    "bug_complete_": ("bug", "complete"),
+    "bug_progress_": ("bug", "progress"),
+    "bug_reject_": ("bug", "reject"),
+    "app_approve_": ("application", "approve"),
+    "app_reject_": ("application", "reject"),
+}
+_BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+class CallbackData(NamedTuple):
+    entity: str
+    action: str
+    id: int
+    version: Optional[int] = None
+
+def _to_base36(number: int) -> str:
+    if number == 0:
+        return "0"
+    digits = []
+    while number:
+        number, rest = divmod(number, 36)
+        digits.append(_BASE36[rest])
+    return "".join(reversed(digits))
+
+def encode_callback(entity: str, action: str, item_id: int, version: int = None) -> str:
+    """Упаковать действие с сущностью в callback_data"""
+    data = CALLBACK_FORMAT_VERSION + _ENTITY_CODES[entity] + _ACTION_CODES[entity][action] + _to_base36(item_id)
+    if version is not None:
+        data += "." + _to_base36(version)
+    return data
+
+def decode_callback(data: str) -> Optional[CallbackData]:
+    """Распаковать callback_data (компактный или старый формат); None — если это не действие"""
+    if len(data) >= 4 and data[0] == CALLBACK_FORMAT_VERSION:
+        entity = CALLBACK_ENTITIES.get(data[1])
+        action = entity and CALLBACK_ACTIONS[entity].get(data[2])
+        if action:
+            item_id, _, version = data[3:].partition(".")
+            try:
+                return CallbackData(entity, action, int(item_id, 36), int(version, 36) if version else None)
+            except ValueError:
+                return None
+        return None
+    prefix, _, item_id = data.rpartition("_")
+    legacy = LEGACY_CALLBACK_PREFIXES.get(prefix + "_")
+    if legacy and item_id.isdigit():
+        return CallbackData(legacy[0], legacy[1], int(item_id))
+    return None
+
+def stale_action_text(title: str) -> str:
+    """Ответ на устаревшую кнопку: запись уже изменил другой админ, её нет или переход недопустим"""
+    return f"⚠️ {title}: статус уже изменён — действие не применено."
+
+class RecentCallbacks:
+    """Недавно обработанные callback_query.id: повторная доставка того же нажатия игнорируется"""
+
+    def __init__(self, ttl: float = CALLBACK_DEDUPE_TTL, max_entries: int = CALLBACK_DEDUPE_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen = OrderedDict()   # id -> время первого нажатия
+        self.replays = 0
+
+    def seen(self, query_id: str) -> bool:
+        """Отметить нажатие; True — если оно уже обрабатывалось"""
+        now = time.monotonic()
+        while self._seen and (len(self._seen) >= self.max_entries or next(iter(self._seen.values())) < now - self.ttl):
+            self._seen.popitem(last=False)
+        if query_id in self._seen:
+            self.replays += 1
+            return True
+        self._seen[query_id] = now
+        return False
+
+recent_callbacks = RecentCallbacks()
+
 def get_main_menu_keyboard(is_admin: bool, is_super_admin: bool):
     """Получить клавиатуру главного меню"""
     keyboard = [
@@ -280,6 +2621,63 @@ def get_main_menu_keyboard(is_admin: bool, is_super_admin: bool):
     
     return keyboard
 
+# === ВЛОЖЕНИЯ В СООБЩЕНИЯХ ===
+
+def draft_media(data: dict) -> list:
+    """Вложения черновика (черновики, начатые до поддержки альбомов, хранят только media_file_id)"""
+    if 'media' in data:
+        return data['media']
+    file_id = data.get('media_file_id')
+    return [{"file_id": file_id, "kind": "photo", "unique_id": file_id}] if file_id else []
+
+def _input_media(item: dict):
+    return (InputMediaVideo if item["kind"] == "video" else InputMediaPhoto)(item["file_id"])
+
+async def send_with_media(bot, chat_id: int, text: str, reply_markup, media: list, sent_albums: set = None,
+                          **kwargs):
+    """Отправить текст с кнопками и вложениями; вернуть сообщение с кнопками.
+
+    Одно вложение уходит с текстом в подписи. Несколько — одним sendMediaGroup, а текст с кнопками
+    отдельным сообщением (у альбома кнопок не бывает). Получатели из sent_albums альбом уже получили.
+    """
+    if len(media) == 1:
+        send = bot.send_video if media[0]["kind"] == "video" else bot.send_photo
+        return await send(chat_id, media[0]["file_id"], caption=text, reply_markup=reply_markup, **kwargs)
+    if media and (sent_albums is None or chat_id not in sent_albums):
+        await bot.send_media_group(chat_id, [_input_media(item) for item in media], **kwargs)
+        if sent_albums is not None:
+            sent_albums.add(chat_id)
+    return await bot.send_message(chat_id, text, reply_markup=reply_markup, **kwargs)
+
+class AlbumCollector:
+    """Сборка альбомов: сообщения с одним media_group_id приходят по отдельности, отдаём их одной пачкой"""
+
+    def __init__(self, window: float = ALBUM_WINDOW):
+        self.window = window
+        self._albums = {}   # media_group_id -> (вложения, таймер)
+
+    def add(self, media_group_id: str, item: dict, on_complete):
+        """Добавить вложение; on_complete(items) вызывается, когда за окно не пришло новых"""
+        items, timer = self._albums.get(media_group_id, ([], None))
+        if timer is not None:
+            timer.cancel()
+        items.append(item)
+        timer = asyncio.get_running_loop().call_later(self.window, self._complete, media_group_id, on_complete)
+        self._albums[media_group_id] = (items, timer)
+
+    def _complete(self, media_group_id: str, on_complete):
+        items, _ = self._albums.pop(media_group_id)
+        spawn(self._deliver(media_group_id, on_complete, items))
+
+    async def _deliver(self, media_group_id: str, on_complete, items: list):
+        # Вызов идёт из таймера, мимо Application, — без этого ошибка пропала бы молча
+        try:
+            await on_complete(items)
+        except Exception as e:
+            logger.error(f"❌ Не удалось обработать альбом {media_group_id} ({len(items)} вложений): {e}")
+
+albums = AlbumCollector()
+
 # === ОБРАБОТЧИКИ КОМАНД ===
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -310,19 +2708,17 @@ async def get_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 async def cancel_any_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отменить любой активный процесс"""
     user_id = update.effective_user.id
+    flow, _ = await sessions.get_flow(user_id)
 
-    if user_id in USER_DATA:
-        del USER_DATA[user_id]
-        await update.message.reply_text("🚫 Создание ТЗ отменено.")
-    elif user_id in USER_BUG_DATA:
-        del USER_BUG_DATA[user_id]
-        await update.message.reply_text("🚫 Создание бага отменено.")
-    elif user_id in USER_APPLICATION:
-        del USER_APPLICATION[user_id]
-        await update.message.reply_text("🚫 Подача заявки отменена.")
-    elif user_id in ADMIN_USER_DATA:
-        del ADMIN_USER_DATA[user_id]
-        await update.message.reply_text("🚫 Процесс отменён.")
+    messages = {
+        'task': "🚫 Создание ТЗ отменено.",
+        'bug': "🚫 Создание бага отменено.",
+        'application': "🚫 Подача заявки отменена.",
+        'admin': "🚫 Процесс отменён.",
+    }
+    if flow:
+        sessions.drop(user_id)
+        await update.message.reply_text(messages[flow])
     else:
         await update.message.reply_text("ℹ️ Нет активного процесса.")
 
@@ -333,7 +2729,7 @@ async def create_task_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    USER_DATA[user_id] = {'step': 'awaiting_description'}
+    sessions.put(user_id, 'task', {'step': 'awaiting_description'})
     await query.message.reply_text("📝 Введите описание задачи:")
 
 async def confirm_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -341,7 +2737,7 @@ async def confirm_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    data = USER_DATA.get(user_id)
+    data = await sessions.get(user_id, 'task')
 
     if not data or data.get('step') != 'preview':
         await query.message.reply_text("❌ Сессия устарела. Начните заново с /start")
@@ -350,47 +2746,51 @@ async def confirm_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     author_username = update.effective_user.username or "user"
     
     try:
-        task_id = await create_task(
+        task = await create_task(
             author_id=user_id,
             author_username=f"@{author_username}",
             description=data['description'],
-            media_file_id=data.get('media_file_id')
+            media=draft_media(data)
         )
+        task_id = task.id
 
-        # Отправляем всем админам
+        # Админам в режиме сводки — в очередь, остальным сразу и параллельно
         admins = await get_admins()
-        sent_to_anyone = False
+        admin_names = dict(admins)
+        digest_admins = [admin_id for admin_id in admin_names if admin_registry.wants_digest(admin_id)]
+        immediate = [admin_id for admin_id in admin_names if not admin_registry.wants_digest(admin_id)]
+        text = f"📄 Новое ТЗ #{task_id} от @{author_username}:\n\n{data['description']}"
+        keyboard = [
+            [
+                InlineKeyboardButton("✅ Выполнить",
+                                     callback_data=encode_callback("task", "complete", task_id, task.version)),
+                InlineKeyboardButton("❌ Отклонить",
+                                     callback_data=encode_callback("task", "reject", task_id, task.version))
+            ]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        media = draft_media(data)
+        sent_albums = set()
 
-        for admin_id, admin_username in admins:
-            try:
-                text = f"📄 Новое ТЗ #{task_id} от @{author_username}:\n\n{data['description']}"
-                keyboard = [
-                    [
-                        InlineKeyboardButton("✅ Выполнить", callback_data=f"complete_{task_id}"),
-                        InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{task_id}")
-                    ]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+        async def send_to_admin(admin_id: int):
+            await send_with_media(context.bot, admin_id, text, reply_markup, media, sent_albums)
 
-                if data.get('media_file_id'):
-                    await context.bot.send_photo(
-                        chat_id=admin_id,
-                        photo=data['media_file_id'],
-                        caption=text,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=text,
-                        reply_markup=reply_markup
-                    )
-                sent_to_anyone = True
-            except Exception as e:
-                logger.warning(f"Не удалось отправить админу {admin_username}: {e}")
+        async def log_failures(delivery: FanOutDelivery):
+            results = await delivery.wait()
+            for admin_id, result in results.items():
+                if result is not True:
+                    logger.warning(f"Не удалось отправить админу {admin_names[admin_id]}: {result}")
+
+        for admin_id in await digests.add(task_id, digest_admins):
+            context.job_queue.run_once(flush_digest, when=0, data=admin_id)
+        delivery = fan_out(immediate, send_to_admin)
+        spawn(log_failures(delivery))
 
-        if sent_to_anyone:
+        # Отвечаем автору сразу после первой успешной доставки
+        if await delivery.first_success():
             await query.message.reply_text("✅ ТЗ успешно создано и отправлено администраторам!")
+        elif digest_admins:
+            await query.message.reply_text("✅ ТЗ успешно создано! Администраторы получат его в ближайшей сводке.")
         else:
             await query.message.reply_text("⚠️ Не удалось отправить ТЗ администраторам.")
 
@@ -398,15 +2798,14 @@ async def confirm_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         logger.error(f"Ошибка создания ТЗ: {e}")
         await query.message.reply_text("❌ Не удалось создать ТЗ. Попробуйте позже.")
 
-    if user_id in USER_DATA:
-        del USER_DATA[user_id]
+    sessions.drop(user_id, 'task')
 
 async def edit_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Изменить ТЗ"""
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    USER_DATA[user_id] = {'step': 'awaiting_description'}
+    sessions.put(user_id, 'task', {'step': 'awaiting_description'})
     await query.message.reply_text("✏️ Введите новое описание задачи:")
 
 async def cancel_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -414,61 +2813,234 @@ async def cancel_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    if user_id in USER_DATA:
-        del USER_DATA[user_id]
+    sessions.drop(user_id, 'task')
     await query.message.reply_text("🚫 Создание ТЗ отменено.")
 
-async def handle_admin_task_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработать действие админа с ТЗ"""
+async def handle_admin_task_action(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CallbackData) -> None:
+    """Обработать действие админа с ТЗ (на нажатие отвечает сам: отказ показывается всплывающим окном)"""
     query = update.callback_query
-    await query.answer()
     user_id = update.effective_user.id
     
     if not await is_admin(user_id):
-        await query.message.reply_text("⛔ У вас нет прав администратора.")
+        await query.answer("⛔ У вас нет прав администратора.", show_alert=True)
         return
 
-    data = query.data
-    if data.startswith("complete_"):
-        task_id = int(data.split("_")[1])
+    task_id = cb.id
+    if cb.action == "complete":
         status = "completed"
         action_text = "✅ выполнено"
-    elif data.startswith("reject_"):
-        task_id = int(data.split("_")[1])
+    elif cb.action == "reject":
         status = "rejected"
         action_text = "❌ отклонено"
     else:
+        await query.answer()
         return
 
     admin_username = update.effective_user.username or "admin"
-    await update_task_status(task_id, status, user_id, f"@{admin_username}")
-
-    # Уведомляем автора
-    task = await get_task_by_id(task_id)
-    if task:
-        author_id = task[1]
-        desc = task[3]
-        try:
-            await context.bot.send_message(
-                chat_id=author_id,
-                text=f"🔔 Ваше ТЗ:\n\n{desc}\n\nбыло {action_text} администратором @{admin_username}."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить автора {author_id}: {e}")
+    # Уведомление автору уходит в outbox той же транзакцией, что и смена статуса
+    task = await update_task_status(
+        task_id, status, user_id, f"@{admin_username}", cb.version,
+        notice=lambda row: f"🔔 Ваше ТЗ:\n\n{row.description}\n\nбыло {action_text} "
+                           f"администратором @{admin_username}."
+    )
+    if not task:
+        # Из pending есть только переходы в конечные статусы, значит ТЗ уже решено: кнопки не нужны
+        await query.answer(stale_action_text(f"ТЗ #{task_id}"), show_alert=True)
+        await query.message.edit_reply_markup(reply_markup=without_buttons_of(query))
+        return
+    await query.answer()
 
+    # В сводке убираем только строку этого ТЗ, остальные кнопки остаются
+    rows = query.message.reply_markup.inline_keyboard if query.message.reply_markup else ()
+    label = f"ТЗ #{task_id}" if len(rows) > 1 else "Статус"
     await query.message.edit_text(
-        text=query.message.text + f"\n\n📌 Статус: {action_text.upper()}",
-        reply_markup=None
+        text=query.message.text + f"\n\n📌 {label}: {action_text.upper()}",
+        reply_markup=without_buttons_of(query)
     )
 
+def without_buttons_of(query) -> Optional[InlineKeyboardMarkup]:
+    """Клавиатура сообщения без строки нажатой кнопки (None, если строк не осталось)"""
+    markup = query.message.reply_markup
+    if markup is None:
+        return None
+    rows = [row for row in markup.inline_keyboard
+            if all(button.callback_data != query.data for button in row)]
+    return InlineKeyboardMarkup(rows) if rows else None
+
+async def list_items(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CallbackData = None) -> None:
+    """Списки активных/выполненных/отклонённых ТЗ и багов с постраничной навигацией"""
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_user.id
+
+    if not await is_admin(user_id):
+        await query.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    # Кнопки меню list_<view> открывают первую страницу ТЗ; навигация приходит как cb (id 0 — первая)
+    if cb:
+        table = "tasks" if cb.entity == "task_list" else "bugs"
+        view, _, direction = cb.action.partition(":")
+        cursor = cb.id or None
+        newer = direction == "newer" and cursor is not None
+    else:
+        view, table, cursor, newer = query.data[len("list_"):], "tasks", None, False
+    if view not in LIST_VIEWS or table not in LIST_VIEWS[view]:
+        return
+
+    rows, has_newer, has_older = await fetch_page(table, LIST_VIEWS[view][table], cursor, newer)
+
+    titles = {"active": "📋 Активные", "completed": "✅ Выполненные", "rejected": "❌ Отклонённые"}
+    kind = "ТЗ" if table == "tasks" else "баги"
+    if rows:
+        lines = [f"{titles[view]} {kind}:\n"]
+        for item_id, author, description, status in rows:
+            short = description if len(description) <= 60 else description[:57] + "..."
+            lines.append(f"#{item_id} {author} [{status}]\n{short}")
+        text = "\n\n".join(lines)
+    else:
+        text = f"{titles[view]} {kind}: пусто."
+
+    keyboard = []
+    nav = []
+    entity = "task_list" if table == "tasks" else "bug_list"
+    if rows and has_newer:
+        nav.append(InlineKeyboardButton("⬅️ Новее", callback_data=encode_callback(entity, f"{view}:newer", rows[0][0])))
+    if rows and has_older:
+        nav.append(InlineKeyboardButton("Старее ➡️", callback_data=encode_callback(entity, view, rows[-1][0])))
+    if nav:
+        keyboard.append(nav)
+    other = "bug_list" if table == "tasks" else "task_list"
+    other_label = "🐞 Баги" if other == "bug_list" else "📄 ТЗ"
+    keyboard.append([InlineKeyboardButton(other_label, callback_data=encode_callback(other, view, 0))])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    if cb:
+        await query.message.edit_text(text, reply_markup=reply_markup)
+    else:
+        await query.message.reply_text(text, reply_markup=reply_markup)
+
 # === СИСТЕМА БАГОВ ===
 
+BUG_STATUS_LABELS = {
+    "pending": "⏳ Ожидает обработки",
+    "in_progress": "🛠️ in_progress",
+    "completed": "✅ completed",
+    "rejected": "❌ rejected",
+}
+
+def bug_keyboard(bug: BugRow) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки поста бага для текущего статуса и версии (у закрытого бага кнопок нет)"""
+    def button(text: str, action: str) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text, callback_data=encode_callback("bug", action, bug.id, bug.version))
+    if bug.status == "pending":
+        return InlineKeyboardMarkup([[
+            button("🟢 Выполнено", "complete"), button("🟡 Выполняется", "progress"), button("🔴 Отклонено", "reject")
+        ]])
+    if bug.status == "in_progress":
+        return InlineKeyboardMarkup([[button("🟢 Выполнено", "complete"), button("🔴 Отклонено", "reject")]])
+    return None
+
+def render_bug_post(bug: BugRow) -> str:
+    """Текст поста бага в группе по состоянию строки"""
+    text = f"🐞 Баг #{bug.id} от {bug.author_username}:\n\n{bug.description}"
+    if bug.duplicate_count:
+        text += f"\n\n🔁 Повторных отчётов: {bug.duplicate_count}"
+    return text + f"\n\nСтатус: {BUG_STATUS_LABELS.get(bug.status, bug.status)}"
+
+class BugPostEditor:
+    """Отложенная перерисовка постов багов в группе: правки одного поста за окно сливаются в одну"""
+
+    def __init__(self, delay: float = BUG_EDIT_DEBOUNCE):
+        self.delay = delay
+        self._timers = {}   # bug_id -> отложенная правка
+        self._bot = None
+        self.coalesced = 0
+
+    def schedule(self, bot, bug_id: int):
+        """Перерисовать пост бага после окна; повторные вызовы в пределах окна сливаются"""
+        self._bot = bot
+        if bug_id in self._timers:
+            self.coalesced += 1
+            return
+        self._timers[bug_id] = spawn(self._edit_later(bug_id))
+
+    async def _edit_later(self, bug_id: int):
+        await asyncio.sleep(self.delay)
+        # Снимаем таймер до чтения строки: изменения, пришедшие после, запланируют новую правку
+        self._timers.pop(bug_id, None)
+        await self.render(bug_id)
+
+    async def render(self, bug_id: int):
+        """Привести пост бага в группе к текущему состоянию строки"""
+        bug = await get_bug_by_id(bug_id)
+        if not bug or not bug.message_id_in_group:
+            return
+        text = render_bug_post(bug)
+        if text == bug.post_rendered:
+            return
+        reply_markup = bug_keyboard(bug)
+        try:
+            # У поста с одним вложением вместо текста подпись; у альбома кнопки в отдельном сообщении
+            if bug.media_file_id and len(await get_attachments("bugs", bug.id)) <= 1:
+                await self._bot.edit_message_caption(
+                    chat_id=GROUP_CHAT_ID, message_id=bug.message_id_in_group, caption=text,
+                    reply_markup=reply_markup
+                )
+            else:
+                await self._bot.edit_message_text(
+                    chat_id=GROUP_CHAT_ID, message_id=bug.message_id_in_group, text=text,
+                    reply_markup=reply_markup
+                )
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                logger.error(f"Не удалось обновить пост бага #{bug.id}: {e}")
+                return
+        except Exception as e:
+            logger.error(f"Не удалось обновить пост бага #{bug.id}: {e}")
+            return
+        await save_bug_post(bug.id, text)
+
+    async def flush(self):
+        """Сразу выполнить отложенные правки (при остановке бота)"""
+        pending = list(self._timers.items())
+        self._timers.clear()
+        for bug_id, timer in pending:
+            timer.cancel()
+            await self.render(bug_id)
+
+bug_posts = BugPostEditor()
+
+async def find_duplicate_candidate(description: str) -> Optional[BugRow]:
+    """Открытый баг, похожий на отчёт (его покажем автору), или None"""
+    match = duplicate_index.find(description)
+    if match is None:
+        return None
+    candidate = await get_bug_by_id(match[0])
+    if candidate is None or candidate.status not in STATUS_TRANSITIONS["bugs"]:
+        duplicate_index.remove(match[0])
+        return None
+    return candidate
+
+async def link_duplicate_bug(user_id: int, author_username: str, data: dict,
+                             original_id: int) -> Optional[BugRow]:
+    """Привязать отчёт к багу, который автор узнал как свой; None — тот баг успели закрыть"""
+    original = await create_duplicate_bug(
+        user_id, author_username, data['description'], draft_media(data), original_id
+    )
+    if original is None:
+        duplicate_index.remove(original_id)
+        return None
+    logger.info(f"🔁 Отчёт от {author_username} привязан к багу #{original_id}")
+    return original
+
 async def create_bug_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Начать создание бага"""
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    USER_BUG_DATA[user_id] = {'step': 'awaiting_description'}
+    sessions.put(user_id, 'bug', {'step': 'awaiting_description'})
     await query.message.reply_text("🐞 Опишите баг (что сломалось, как воспроизвести):")
 
 async def confirm_bug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -476,7 +3048,7 @@ async def confirm_bug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    data = USER_BUG_DATA.get(user_id)
+    data = await sessions.get(user_id, 'bug')
 
     if not data or data.get('step') != 'preview':
         await query.message.reply_text("❌ Сессия устарела. Начните заново с /start")
@@ -485,57 +3057,92 @@ async def confirm_bug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     author_username = update.effective_user.username or "user"
     
     try:
-        bug_id = await create_bug(
-            author_id=user_id,
-            author_username=f"@{author_username}",
-            description=data['description'],
-            media_file_id=data.get('media_file_id')
-        )
-        
-        # Отправляем в группу
-        text = f"🐞 Баг #{bug_id} от @{author_username}:\n\n{data['description']}\n\nСтатус: ⏳ Ожидает обработки"
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("🟢 Выполнено", callback_data=f"bug_complete_{bug_id}"),
-                InlineKeyboardButton("🟡 Выполняется", callback_data=f"bug_progress_{bug_id}"),
-                InlineKeyboardButton("🔴 Отклонено", callback_data=f"bug_reject_{bug_id}")
+        # Похожий открытый баг показываем автору: привязать отчёт к нему можно только с его согласия
+        candidate = await find_duplicate_candidate(data['description'])
+        if candidate:
+            data['step'] = 'duplicate_check'
+            data['candidate'] = candidate.id
+            sessions.put(user_id, 'bug', data)
+            description = candidate.description
+            if len(description) > DIGEST_PREVIEW_CHARS:
+                description = description[:DIGEST_PREVIEW_CHARS - 1] + "…"
+            keyboard = [
+                [InlineKeyboardButton("✅ Да, это он", callback_data="bug_duplicate_yes")],
+                [InlineKeyboardButton("🆕 Нет, у меня другой баг", callback_data="bug_duplicate_no")]
             ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            await query.message.reply_text(
+                f"🔎 Похожий баг уже на рассмотрении:\n\n#{candidate.id}: {description}\n\nЭто ваш баг?",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return
+        await post_new_bug(context, user_id, author_username, data)
+        await query.message.reply_text("✅ Баг отправлен в группу на рассмотрение!")
+        
+    except Exception as e:
+        logger.error(f"Ошибка создания бага: {e}")
+        await query.message.reply_text("❌ Не удалось создать баг. Попробуйте позже.")
+
+    sessions.drop(user_id, 'bug')
+
+async def answer_duplicate_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ответ автора на «это ваш баг?»: привязать отчёт к найденному багу или опубликовать как новый"""
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_user.id
+    data = await sessions.get(user_id, 'bug')
+
+    if not data or data.get('step') != 'duplicate_check':
+        await query.message.reply_text("❌ Сессия устарела. Начните заново с /start")
+        return
+
+    author_username = update.effective_user.username or "user"
+    await query.edit_message_reply_markup(reply_markup=None)
 
-        if data.get('media_file_id'):
-            sent_message = await context.bot.send_photo(
-                chat_id=GROUP_CHAT_ID,
-                message_thread_id=TOPIC_THREAD_ID_BUGS,
-                photo=data['media_file_id'],
-                caption=text,
-                reply_markup=reply_markup
+    try:
+        original = None
+        if query.data == "bug_duplicate_yes":
+            # Повторный отчёт не публикуется: счётчик исходного бага растёт, пост перерисовывается
+            original = await link_duplicate_bug(user_id, f"@{author_username}", data, data['candidate'])
+        if original:
+            bug_posts.schedule(context.bot, original.id)
+            await query.message.reply_text(
+                f"🔁 Ваш отчёт привязан к багу #{original.id}. Мы сообщим, когда его статус изменится."
             )
         else:
-            sent_message = await context.bot.send_message(
-                chat_id=GROUP_CHAT_ID,
-                message_thread_id=TOPIC_THREAD_ID_BUGS,
-                text=text,
-                reply_markup=reply_markup
-            )
+            await post_new_bug(context, user_id, author_username, data)
+            await query.message.reply_text("✅ Баг отправлен в группу на рассмотрение!")
 
-        await update_bug_status(bug_id, "pending", 0, "system", sent_message.message_id)
-        await query.message.reply_text("✅ Баг отправлен в группу на рассмотрение!")
-        
     except Exception as e:
         logger.error(f"Ошибка создания бага: {e}")
         await query.message.reply_text("❌ Не удалось создать баг. Попробуйте позже.")
 
-    if user_id in USER_BUG_DATA:
-        del USER_BUG_DATA[user_id]
+    sessions.drop(user_id, 'bug')
+
+async def post_new_bug(context: ContextTypes.DEFAULT_TYPE, user_id: int, author_username: str,
+                       data: dict) -> None:
+    """Создать баг, опубликовать его в группе и добавить в индекс повторов"""
+    bug = await create_bug(
+        author_id=user_id,
+        author_username=f"@{author_username}",
+        description=data['description'],
+        media=draft_media(data)
+    )
+    text = render_bug_post(bug)
+    reply_markup = bug_keyboard(bug)
+    sent_message = await send_with_media(
+        context.bot, GROUP_CHAT_ID, text, reply_markup, draft_media(data),
+        message_thread_id=TOPIC_THREAD_ID_BUGS
+    )
+
+    await save_bug_post(bug.id, text, sent_message.message_id)
+    duplicate_index.add(bug.id, bug.description)
 
 async def edit_bug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Изменить баг"""
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    USER_BUG_DATA[user_id] = {'step': 'awaiting_description'}
+    sessions.put(user_id, 'bug', {'step': 'awaiting_description'})
     await query.message.reply_text("✏️ Введите новое описание бага:")
 
 async def cancel_bug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -543,102 +3150,62 @@ async def cancel_bug(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    if user_id in USER_BUG_DATA:
-        del USER_BUG_DATA[user_id]
+    sessions.drop(user_id, 'bug')
     await query.message.reply_text("🚫 Создание бага отменено.")
 
-async def handle_bug_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработать действие с багом"""
+async def handle_bug_action(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CallbackData) -> None:
+    """Обработать действие с багом (на нажатие отвечает сам: отказ показывается всплывающим окном)"""
     query = update.callback_query
-    await query.answer()
     user_id = update.effective_user.id
 
     if not await is_admin(user_id):
-        await query.message.reply_text("⛔ Только администраторы могут менять статус багов.")
+        await query.answer("⛔ Только администраторы могут менять статус багов.", show_alert=True)
         return
 
-    data = query.data
-    bug_id = None
-    status = ""
-    emoji = ""
-
-    if data.startswith("bug_complete_"):
-        bug_id = int(data.split("_")[2])
+    bug_id = cb.id
+    if cb.action == "complete":
         status = "completed"
         emoji = "✅"
-    elif data.startswith("bug_progress_"):
-        bug_id = int(data.split("_")[2])
+    elif cb.action == "progress":
         status = "in_progress"
         emoji = "🛠️"
-    elif data.startswith("bug_reject_"):
-        bug_id = int(data.split("_")[2])
+    elif cb.action == "reject":
         status = "rejected"
         emoji = "❌"
     else:
+        await query.answer()
         return
 
     admin_username = update.effective_user.username or "admin"
-    bug = await get_bug_by_id(bug_id)
+    # Уведомления автору и авторам повторных отчётов уходят в outbox той же транзакцией
+    bug = await update_bug_status(
+        bug_id, status, user_id, f"@{admin_username}", cb.version,
+        notice=lambda row: f"🔔 Ваш баг:\n\n{row.description}\n\nизменил статус на: {emoji} {status} "
+                           f"(администратор @{admin_username})",
+        duplicate_notice=lambda row: f"🔔 Баг, о котором вы сообщали:\n\n{row.description}\n\n"
+                                     f"изменил статус на: {emoji} {status}"
+    )
     if not bug:
-        await query.message.reply_text("❌ Баг не найден.")
+        # Кнопки поста уже обновил тот, кто успел раньше; в группу ничего не пишем
+        await query.answer(stale_action_text(f"Баг #{bug_id}"), show_alert=True)
         return
+    await query.answer()
+    if status in ("completed", "rejected"):
+        duplicate_index.remove(bug_id)
 
-    await update_bug_status(bug_id, status, user_id, f"@{admin_username}")
-
-    # Уведомляем автора
-    author_id = bug[1]
-    desc = bug[3]
-    try:
-        await context.bot.send_message(
-            chat_id=author_id,
-            text=f"🔔 Ваш баг:\n\n{desc}\n\nизменил статус на: {emoji} {status} (администратор @{admin_username})"
-        )
-    except Exception as e:
-        logger.error(f"Не удалось уведомить автора бага {author_id}: {e}")
-
-    # Обновляем сообщение в группе
-    message_id_in_group = bug[8]
-    if message_id_in_group:
-        try:
-            new_text = query.message.text.split("\n\nСтатус:")[0] + f"\n\nСтатус: {emoji} {status}"
-            
-            # Генерируем новую клавиатуру
-            keyboard = []
-            if status == "in_progress":
-                keyboard = [
-                    [
-                        InlineKeyboardButton("🟢 Выполнено", callback_data=f"bug_complete_{bug_id}"),
-                        InlineKeyboardButton("🔴 Отклонено", callback_data=f"bug_reject_{bug_id}")
-                    ]
-                ]
-            elif status not in ["completed", "rejected"]:
-                keyboard = [
-                    [
-                        InlineKeyboardButton("🟢 Выполнено", callback_data=f"bug_complete_{bug_id}"),
-                        InlineKeyboardButton("🟡 Выполняется", callback_data=f"bug_progress_{bug_id}"),
-                        InlineKeyboardButton("🔴 Отклонено", callback_data=f"bug_reject_{bug_id}")
-                    ]
-                ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-            
-            await context.bot.edit_message_text(
-                chat_id=GROUP_CHAT_ID,
-                message_id=message_id_in_group,
-                text=new_text,
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logger.error(f"Не удалось обновить сообщение бага в группе: {e}")
-
-    # Обновляем сообщение у админа
-    await query.message.edit_text(
-        text=query.message.text.split("\n\nСтатус:")[0] + f"\n\nСтатус: {emoji} {status}",
-        reply_markup=None
-    )
+    # Кнопки с новой версией ставим сразу, иначе следующее нажатие в окне отложенной правки устареет;
+    # текст поста перерисуется по строке бага, частые переключения статуса сольются в одну правку
+    await query.message.edit_reply_markup(reply_markup=bug_keyboard(bug))
+    bug_posts.schedule(context.bot, bug_id)
 
 # === СИСТЕМА ЗАЯВОК ===
 
+def cooldown_text(left: float) -> str:
+    days, rest = divmod(int(left) + 59, 86400)
+    hours, minutes = rest // 3600, rest % 3600 // 60
+    wait = f"{days} дн. {hours} ч." if days else f"{hours} ч. {minutes} мин."
+    return f"⏳ Вы уже подавали заявку недавно. Повторно можно будет подать через {wait}"
+
 async def start_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Начать подачу заявки"""
     query = update.callback_query
@@ -646,15 +3213,11 @@ async def start_application(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     user_id = update.effective_user.id
     
-    # Проверка на повторную заявку
-    app = await get_last_application(user_id)
-    if app:
-        created_at = datetime.strptime(app[13], "%Y-%m-%d %H:%M:%S")
-        if datetime.now() - created_at < timedelta(days=7):
-            await query.message.reply_text(
-                "⏳ Вы уже подавали заявку в течение последних 7 дней. Повторно можно через 7 дней с момента подачи."
-            )
-            return
+    # Проверка на повторную заявку (по индексу в памяти, без запроса к БД)
+    left = application_cooldowns.remaining(user_id)
+    if left:
+        await query.message.reply_text(cooldown_text(left))
+        return
 
     keyboard = [
         [InlineKeyboardButton("🛠️ Хелпер", callback_data="apply_helper")],
@@ -681,11 +3244,11 @@ async def set_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else:
         return
 
-    USER_APPLICATION[user_id] = {
+    sessions.put(user_id, 'application', {
         'step': 0,
         'position': position,
         'answers': []
-    }
+    })
     await query.message.reply_text(f"Вы выбрали: {position}\n\n{QUESTIONS[0]}")
 
 async def confirm_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -693,16 +3256,24 @@ async def confirm_application(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    app_data = USER_APPLICATION.get(user_id)
+    app_data = await sessions.get(user_id, 'application')
 
     if not app_data or app_data.get('step') != 'preview':
         await query.message.reply_text("❌ Сессия устарела. Начните заново.")
         return
 
     username = update.effective_user.username or f"user{user_id}"
+
+    # Пока заполнялась анкета, могла уйти другая заявка
+    left = application_cooldowns.remaining(user_id)
+    if left:
+        sessions.drop(user_id, 'application')
+        await query.message.reply_text(cooldown_text(left))
+        return
     
     try:
-        app_id = await create_application(user_id, f"@{username}", app_data['position'], app_data['answers'])
+        app = await create_application(user_id, f"@{username}", app_data['position'], app_data['answers'])
+        app_id = app.id
         
         # Отправка в группу
         text = f"📄 Заявка #{app_id} на должность: {app_data['position']}\nОт: @{username}\n\n"
@@ -711,8 +3282,10 @@ async def confirm_application(update: Update, context: ContextTypes.DEFAULT_TYPE
 
         keyboard = [
             [
-                InlineKeyboardButton("✅ Одобрить", callback_data=f"app_approve_{app_id}"),
-                InlineKeyboardButton("❌ Отклонить", callback_data=f"app_reject_{app_id}")
+                InlineKeyboardButton("✅ Одобрить",
+                                     callback_data=encode_callback("application", "approve", app_id, app.version)),
+                InlineKeyboardButton("❌ Отклонить",
+                                     callback_data=encode_callback("application", "reject", app_id, app.version))
             ]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -731,20 +3304,20 @@ async def confirm_application(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Ошибка отправки заявки: {e}")
         await query.message.reply_text("❌ Не удалось отправить заявку. Попробуйте позже.")
 
-    if user_id in USER_APPLICATION:
-        del USER_APPLICATION[user_id]
+    sessions.drop(user_id, 'application')
 
 async def edit_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Изменить заявку"""
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    if user_id in USER_APPLICATION:
-        USER_APPLICATION[user_id] = {
+    app_data = await sessions.get(user_id, 'application')
+    if app_data:
+        sessions.put(user_id, 'application', {
             'step': 0,
-            'position': USER_APPLICATION[user_id]['position'],
+            'position': app_data['position'],
             'answers': []
-        }
+        })
         await query.message.reply_text(QUESTIONS[0])
 
 async def cancel_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -752,49 +3325,39 @@ async def cancel_application(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
-    if user_id in USER_APPLICATION:
-        del USER_APPLICATION[user_id]
+    sessions.drop(user_id, 'application')
     await query.message.reply_text("🚫 Подача заявки отменена.")
 
-async def handle_application_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработать действие с заявкой"""
+async def handle_application_action(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CallbackData) -> None:
+    """Обработать действие с заявкой (на нажатие отвечает сам: отказ показывается всплывающим окном)"""
     query = update.callback_query
-    await query.answer()
     user_id = update.effective_user.id
 
     if not await is_admin(user_id):
-        await query.message.reply_text("⛔ Только администраторы могут принимать заявки.")
+        await query.answer("⛔ Только администраторы могут принимать заявки.", show_alert=True)
         return
 
-    data = query.data
-    app_id = None
-    status = ""
-    message = ""
-
-    if data.startswith("app_approve_"):
-        app_id = int(data.split("_")[2])
+    app_id = cb.id
+    if cb.action == "approve":
         status = "approved"
         message = "✅ Ваша заявка одобрена! Ожидайте, когда вам напишет модератор."
-    elif data.startswith("app_reject_"):
-        app_id = int(data.split("_")[2])
+    elif cb.action == "reject":
         status = "rejected"
         message = "❌ Ваша заявка отклонена."
     else:
+        await query.answer()
         return
 
-    app = await get_application_by_id(app_id)
+    admin_username = update.effective_user.username or "admin"
+    app = await update_application_status(
+        app_id, status, user_id, f"@{admin_username}", cb.version, notice=lambda row: message
+    )
     if not app:
-        await query.message.reply_text("❌ Заявка не найдена.")
+        # Из pending есть только переходы в конечные статусы, значит заявка уже решена: кнопки не нужны
+        await query.answer(stale_action_text(f"Заявка #{app_id}"), show_alert=True)
+        await query.message.edit_reply_markup(reply_markup=None)
         return
-
-    await update_application_status(app_id, status)
-
-    # Уведомляем автора
-    author_id = app[1]
-    try:
-        await context.bot.send_message(chat_id=author_id, text=message)
-    except Exception as e:
-        logger.error(f"Не удалось уведомить автора заявки {author_id}: {e}")
+    await query.answer()
 
     # Обновляем сообщение в группе
     await query.message.edit_text(
@@ -802,25 +3365,132 @@ async def handle_application_action(update: Update, context: ContextTypes.DEFAUL
         reply_markup=None
     )
 
+# === ПОИСК ===
+
+def render_search_page(state: dict, page: int):
+    """Текст и кнопки страницы результатов поиска"""
+    hits = state["hits"]
+    pages = max(1, -(-len(hits) // SEARCH_PAGE_SIZE))
+    page = max(0, min(page, pages - 1))
+    if not hits:
+        return f"🔎 «{state['query']}»: ничего не найдено.", None
+
+    labels = {"tasks": "📄 ТЗ", "bugs": "🐞 Баг", "applications": "📝 Заявка"}
+    more = "+" if len(hits) >= SEARCH_MAX_RESULTS else ""
+    lines = [f"🔎 «{state['query']}»: найдено {len(hits)}{more}, страница {page + 1}/{pages}"]
+    for hit in hits[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]:
+        lines.append(f"{labels[hit.kind]} #{hit.id} [{hit.status}]\n{hit.snippet}")
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback("search", "page", page - 1)))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("Дальше ➡️", callback_data=encode_callback("search", "page", page + 1)))
+    return "\n\n".join(lines), InlineKeyboardMarkup([nav]) if nav else None
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Поиск по ТЗ, багам и заявкам: /search <слова>"""
+    if not await is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    text = " ".join(context.args or []).strip()
+    if not text:
+        await update.message.reply_text("🔎 Использование: /search <слова для поиска>")
+        return
+
+    # Результаты кэшируются у пользователя: листание страниц не обращается к БД
+    context.user_data["search"] = {"query": text, "hits": await search(text)}
+    message_text, reply_markup = render_search_page(context.user_data["search"], 0)
+    await update.message.reply_text(message_text, reply_markup=reply_markup)
+
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CallbackData) -> None:
+    """Листание результатов поиска"""
+    query = update.callback_query
+    await query.answer()
+
+    if not await is_admin(update.effective_user.id):
+        return
+
+    state = context.user_data.get("search")
+    if not state:
+        await query.message.reply_text("⌛ Результаты поиска устарели, повторите /search.")
+        return
+    message_text, reply_markup = render_search_page(state, cb.id)
+    await query.message.edit_text(message_text, reply_markup=reply_markup)
+
+# === СТАТИСТИКА ===
+
+STATS_ENTITIES = (("tasks", "📝 ТЗ", "ТЗ"), ("bugs", "🐞 Баги", "баги"), ("applications", "📄 Заявки", "заявки"))
+STATS_STATUS_LABELS = {
+    "pending": "⏳ ожидают",
+    "in_progress": "🛠️ в работе",
+    "completed": "✅ выполнено",
+    "approved": "✅ одобрено",
+    "rejected": "❌ отклонено",
+    "duplicate": "🔁 повторы",
+}
+
+def format_stats(stats: QueueStats) -> str:
+    """Текст сводки /stats"""
+    lines = ["📊 Статистика очередей"]
+    for entity, title, _ in STATS_ENTITIES:
+        counts = [(status, count) for (table, status), count in stats.counters.items()
+                  if table == entity and count]
+        lines.append(f"\n{title}: {sum(count for _, count in counts)}")
+        order = list(STATS_STATUS_LABELS)
+        counts.sort(key=lambda item: order.index(item[0]) if item[0] in order else len(order))
+        for status, count in counts:
+            lines.append(f"• {STATS_STATUS_LABELS.get(status, status)}: {count}")
+    if stats.resolved:
+        lines.append("\n🏆 Решено админами:")
+        for admin_id, username, counts in stats.resolved[:LIST_PAGE_SIZE]:
+            parts = ", ".join(f"{short} {counts[entity]}" for entity, _, short in STATS_ENTITIES
+                              if counts.get(entity))
+            lines.append(f"• {username}: {parts}")
+    return "\n".join(lines)
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сводка по очередям (кнопкой в админ-панели или командой /stats)"""
+    query = update.callback_query
+    if query:
+        await query.answer()
+    message = update.effective_message
+
+    if not await is_admin(update.effective_user.id):
+        await message.reply_text("⛔ Статистика доступна только администраторам.")
+        return
+
+    await message.reply_text(format_stats(await get_stats()))
+
 # === АДМИН-ПАНЕЛЬ ===
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Админ-панель"""
+    """Админ-панель (кнопкой или командой /admin; /admin stats — метрики задержек)"""
     query = update.callback_query
-    await query.answer()
+    if query:
+        await query.answer()
+    message = update.effective_message
     user_id = update.effective_user.id
     
     if user_id != SUPER_ADMIN_ID:
-        await query.message.reply_text("⛔ Только суперадмин может управлять админами.")
+        await message.reply_text("⛔ Только суперадмин может управлять админами.")
+        return
+
+    if context.args and context.args[0] == "stats":
+        await message.reply_text(format_metrics())
         return
 
     keyboard = [
         [InlineKeyboardButton("➕ Добавить админа", callback_data="add_admin_start")],
         [InlineKeyboardButton("📋 Список админов", callback_data="list_admins")],
+        [InlineKeyboardButton("📤 Очередь отправки", callback_data="outbound_queue")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="stats")],
+        [InlineKeyboardButton("⏱ Метрики", callback_data="metrics")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.reply_text("👑 Админ-панель:", reply_markup=reply_markup)
+    await message.reply_text("👑 Админ-панель:", reply_markup=reply_markup)
 
 async def add_admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Начать добавление админа"""
@@ -831,7 +3501,7 @@ async def add_admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if user_id != SUPER_ADMIN_ID:
         return
         
-    ADMIN_USER_DATA[user_id] = {'step': 'awaiting_admin_username'}
+    sessions.put(user_id, 'admin', {'step': 'awaiting_admin_username'})
     await query.message.reply_text("✏️ Отправьте @username пользователя для назначения админом:")
 
 async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -846,6 +3516,145 @@ async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         text = "📋 Список администраторов:\n" + "\n".join([f"• {username} (ID: {uid})" for uid, username in admins])
     await query.message.reply_text(text)
 
+async def show_outbound_queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Глубина очереди исходящих сообщений"""
+    query = update.callback_query
+    await query.answer()
+
+    if update.effective_user.id != SUPER_ADMIN_ID:
+        return
+
+    depth = outbound.depth()
+    names = {PRIORITY_EDIT: "правки статусов", PRIORITY_POST: "новые посты", PRIORITY_NOTIFY: "уведомления",
+             PRIORITY_BROADCAST: "рассылка"}
+    lines = [f"📤 В очереди: {outbound.size} (слито правок: {outbound.coalesced})"]
+    lines += [f"• {names.get(p, p)}: {count}" for p, count in sorted(depth.items())]
+    if antiflood.rejected:
+        top = sorted(antiflood.rejected_commands.items(), key=lambda item: -item[1])[:5]
+        lines.append(f"\n🚧 Антифлуд отбросил: {antiflood.rejected} (лимит пользователя: {antiflood.rejected_users})")
+        lines += [f"• {command}: {count}" for command, count in top]
+    pending = await outbox.stats()
+    lines.append(
+        f"\n📬 Уведомления авторам: ждут {pending.get('pending', 0)}, не доставлено {pending.get('dead', 0)} "
+        f"(отправлено {outbox.sent}, повторов {outbox.retried})"
+    )
+    if digests.queued or digests.sent:
+        lines.append(f"📋 Сводки ТЗ: ждут {digests.queued}, отправлено сводок {digests.sent}")
+    busiest = sorted(outbound.depth_by_chat().items(), key=lambda item: -item[1])[:5]
+    if busiest:
+        lines.append("\nЧаты:")
+        lines += [f"• {chat_id} / тема {thread_id}: {count}" for (chat_id, thread_id), count in busiest]
+    await query.message.reply_text("\n".join(lines))
+
+def format_metrics() -> str:
+    """Сводка самых затратных участков для админ-панели"""
+    if not metrics.enabled:
+        return "⏱ Метрики выключены (запустите бота с --metrics)."
+    rows = metrics.top()
+    if not rows:
+        return "⏱ Замеров пока нет."
+    lines = ["⏱ Самые затратные участки (вызовов, среднее, p50 / p99):"]
+    for family, label, h in rows:
+        lines.append(
+            f"• {family} {label}: {h.count}, {h.total / h.count * 1000:.1f} мс, "
+            f"{h.quantile(0.5) * 1000:.1f} / {h.quantile(0.99) * 1000:.1f} мс"
+        )
+    return "\n".join(lines)
+
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Метрики задержек"""
+    query = update.callback_query
+    await query.answer()
+
+    if update.effective_user.id != SUPER_ADMIN_ID:
+        return
+
+    await query.message.reply_text(format_metrics())
+
+async def toggle_digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Переключить доставку новых ТЗ админу: сводкой или каждое сразу (/digest)"""
+    user_id = update.effective_user.id
+    if not await is_admin(user_id):
+        await update.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    digest = not admin_registry.wants_digest(user_id)
+    await set_notify_mode(user_id, digest)
+    if digest:
+        await update.message.reply_text(
+            f"📬 Новые ТЗ будут приходить сводкой раз в {DIGEST_INTERVAL // 60} мин "
+            f"(или сразу, как наберётся {DIGEST_MAX_ITEMS}). Вернуть как было — /digest"
+        )
+    else:
+        # Накопленное не ждёт следующей сводки
+        context.job_queue.run_once(flush_digest, when=0, data=user_id)
+        await update.message.reply_text("🔔 Новые ТЗ снова будут приходить сразу. Сводка — /digest")
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Рассылка всем пользователям бота: /broadcast <текст>"""
+    user_id = update.effective_user.id
+    if user_id != SUPER_ADMIN_ID:
+        await update.message.reply_text("⛔ Рассылка доступна только суперадмину.")
+        return
+
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("ℹ️ Использование: /broadcast <текст сообщения>")
+        return
+    if broadcaster.running:
+        await update.message.reply_text("⏳ Предыдущая рассылка ещё не закончилась.")
+        return
+
+    text = parts[1]
+    sessions.put(user_id, 'admin', {'step': 'broadcast_preview', 'text': text})
+    keyboard = [
+        [InlineKeyboardButton("✅ Разослать", callback_data="broadcast_confirm")],
+        [InlineKeyboardButton("❌ Отменить", callback_data="broadcast_cancel")]
+    ]
+    await update.message.reply_text(f"📣 Получателей: {await count_recipients()}. Сообщение:")
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Запустить подготовленную рассылку"""
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_user.id
+    if user_id != SUPER_ADMIN_ID:
+        return
+
+    data = await sessions.get(user_id, 'admin')
+    if not data or data.get('step') != 'broadcast_preview':
+        await query.message.reply_text("❌ Сессия устарела. Начните заново.")
+        return
+    sessions.drop(user_id, 'admin')
+    if broadcaster.running:
+        await query.message.reply_text("⏳ Предыдущая рассылка ещё не закончилась.")
+        return
+
+    await query.edit_message_reply_markup(reply_markup=None)
+    await broadcaster.start(context.bot, user_id, data['text'], query.message.chat_id)
+
+async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отменить подготовленную рассылку"""
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_user.id
+    sessions.drop(user_id, 'admin')
+    await query.edit_message_reply_markup(reply_markup=None)
+    await query.message.reply_text("❌ Рассылка отменена.")
+
+async def handle_broadcast_action(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: CallbackData) -> None:
+    """Остановить идущую рассылку"""
+    query = update.callback_query
+    await query.answer()
+    if update.effective_user.id != SUPER_ADMIN_ID or cb.action != "stop":
+        return
+
+    if broadcaster.cancel(cb.id):
+        await query.message.reply_text(f"⏹ Рассылка #{cb.id} остановится после текущей страницы получателей.")
+    else:
+        await query.edit_message_reply_markup(reply_markup=None)
+
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Вернуться в главное меню"""
     query = update.callback_query
@@ -864,30 +3673,33 @@ async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик текстовых сообщений"""
     user_id = update.effective_user.id
+    flow, data = await sessions.get_flow(user_id)
     
     # Обработка ТЗ
-    if user_id in USER_DATA:
-        step = USER_DATA[user_id].get('step')
+    if flow == 'task':
+        step = data.get('step')
         if step == 'awaiting_description':
-            USER_DATA[user_id]['description'] = update.message.text
-            USER_DATA[user_id]['step'] = 'awaiting_media'
+            data['description'] = update.message.text
+            data['step'] = 'awaiting_media'
+            sessions.put(user_id, 'task', data)
             await update.message.reply_text("📸 Прикрепите фото/видео (опционально) или отправьте /skip")
             return
     
     # Обработка багов
-    if user_id in USER_BUG_DATA:
-        step = USER_BUG_DATA[user_id].get('step')
+    if flow == 'bug':
+        step = data.get('step')
         if step == 'awaiting_description':
-            USER_BUG_DATA[user_id]['description'] = update.message.text
-            USER_BUG_DATA[user_id]['step'] = 'awaiting_media'
+            data['description'] = update.message.text
+            data['step'] = 'awaiting_media'
+            sessions.put(user_id, 'bug', data)
             await update.message.reply_text("📸 Прикрепите скриншот/видео (опционально) или отправьте /skip_bug")
             return
     
     # Обработка заявок
-    if user_id in USER_APPLICATION:
-        step = USER_APPLICATION[user_id].get('step')
+    if flow == 'application':
+        step = data.get('step')
         if isinstance(step, int) and 0 <= step < len(QUESTIONS):
-            app_data = USER_APPLICATION[user_id]
+            app_data = data
             app_data['answers'].append(update.message.text)
             app_data['step'] += 1
 
@@ -906,11 +3718,12 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 await update.message.reply_text(text, reply_markup=reply_markup)
                 app_data['step'] = 'preview'
+            sessions.put(user_id, 'application', app_data)
             return
     
     # Обработка админ-панели
-    if user_id in ADMIN_USER_DATA:
-        step = ADMIN_USER_DATA[user_id].get('step')
+    if flow == 'admin':
+        step = data.get('step')
         if step == 'awaiting_admin_username':
             username = update.message.text.strip()
             if not username.startswith("@"):
@@ -919,57 +3732,67 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 
             await add_admin(0, username)
             await update.message.reply_text(f"✅ Админ {username} добавлен (требуется, чтобы он написал боту /start).")
-            del ADMIN_USER_DATA[user_id]
+            sessions.drop(user_id, 'admin')
             return
     
     await update.message.reply_text("ℹ️ Начните с команды /start")
 
-async def handle_media_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик медиафайлов"""
+def _extract_media(update: Update) -> Optional[dict]:
+    """Вложение из сообщения: фото (наибольшего размера) или видео"""
+    if update.message.photo:
+        file, kind = update.message.photo[-1], "photo"
+    elif update.message.video:
+        file, kind = update.message.video, "video"
+    else:
+        return None
+    return {"file_id": file.file_id, "kind": kind, "unique_id": file.file_unique_id}
+
+async def attach_media(update: Update, context: ContextTypes.DEFAULT_TYPE, flow: str, items: list) -> None:
+    """Добавить вложения к черновику ТЗ или бага и показать предпросмотр"""
     user_id = update.effective_user.id
-    
-    # Обработка медиа для ТЗ
-    if user_id in USER_DATA:
-        step = USER_DATA[user_id].get('step')
-        if step == 'awaiting_media':
-            if update.message.photo:
-                file_id = update.message.photo[-1].file_id
-                USER_DATA[user_id]['media_file_id'] = file_id
-            elif update.message.video:
-                file_id = update.message.video.file_id
-                USER_DATA[user_id]['media_file_id'] = file_id
-            else:
-                USER_DATA[user_id]['media_file_id'] = None
+    data = await sessions.get(user_id, flow)
+    if not data or data.get('step') != 'awaiting_media':
+        return
 
-            await show_task_preview(update, context)
-            return
-    
-    # Обработка медиа для багов
-    if user_id in USER_BUG_DATA:
-        step = USER_BUG_DATA[user_id].get('step')
-        if step == 'awaiting_media':
-            if update.message.photo:
-                file_id = update.message.photo[-1].file_id
-                USER_BUG_DATA[user_id]['media_file_id'] = file_id
-            elif update.message.video:
-                file_id = update.message.video.file_id
-                USER_BUG_DATA[user_id]['media_file_id'] = file_id
-            else:
-                USER_BUG_DATA[user_id]['media_file_id'] = None
+    # Уже известный файл отправляем по сохранённому file_id, повторы в черновике отбрасываем
+    known = await known_media([item["unique_id"] for item in items])
+    media = draft_media(data)
+    seen = {item["unique_id"] for item in media}
+    for item in items:
+        if item["unique_id"] in seen or len(media) >= ALBUM_MAX:
+            continue
+        seen.add(item["unique_id"])
+        media.append(dict(item, file_id=known.get(item["unique_id"], item["file_id"])))
+    data['media'] = media
+    data['media_file_id'] = _first_file_id(media)
+
+    if flow == 'task':
+        await show_task_preview(update, context, data)
+    else:
+        await show_bug_preview(update, context, data)
 
-            await show_bug_preview(update, context)
-            return
+async def handle_media_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик медиафайлов"""
+    user_id = update.effective_user.id
+    flow, data = await sessions.get_flow(user_id)
+
+    # Медиа для ТЗ и багов; альбом копится и показывается одним предпросмотром
+    if flow in ('task', 'bug') and data.get('step') == 'awaiting_media':
+        item = _extract_media(update)
+        if update.message.media_group_id:
+            albums.add(update.message.media_group_id, item,
+                       lambda items: attach_media(update, context, flow, items))
+        else:
+            await attach_media(update, context, flow, [item])
+        return
     
     await update.message.reply_text("📸 Медиафайл получен, но нет активного процесса.")
 
-async def show_task_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def show_task_preview(update: Update, context: ContextTypes.DEFAULT_TYPE, data: dict) -> None:
     """Показать предпросмотр ТЗ"""
     user_id = update.effective_user.id
-    data = USER_DATA[user_id]
     
     desc = data['description']
-    media = data.get('media_file_id')
-
     text = f"🔍 Предпросмотр ТЗ:\n\n{desc}"
     keyboard = [
         [InlineKeyboardButton("✅ Подтвердить", callback_data="confirm_task")],
@@ -977,30 +3800,16 @@ async def show_task_preview(update: Update, context: ContextTypes.DEFAULT_TYPE)
         [InlineKeyboardButton("❌ Отмена", callback_data="cancel_task")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_with_media(context.bot, user_id, text, reply_markup, draft_media(data))
 
-    if media:
-        if update.message and update.message.photo:
-            await update.message.reply_photo(photo=media, caption=text, reply_markup=reply_markup)
-        elif update.message and update.message.video:
-            await update.message.reply_video(video=media, caption=text, reply_markup=reply_markup)
-        else:
-            await context.bot.send_photo(chat_id=user_id, photo=media, caption=text, reply_markup=reply_markup)
-    else:
-        if update.message:
-            await update.message.reply_text(text, reply_markup=reply_markup)
-        else:
-            await context.bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
-
-    USER_DATA[user_id]['step'] = 'preview'
+    data['step'] = 'preview'
+    sessions.put(user_id, 'task', data)
 
-async def show_bug_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def show_bug_preview(update: Update, context: ContextTypes.DEFAULT_TYPE, data: dict) -> None:
     """Показать предпросмотр бага"""
     user_id = update.effective_user.id
-    data = USER_BUG_DATA[user_id]
     
     desc = data['description']
-    media = data.get('media_file_id')
-
     text = f"🔍 Предпросмотр бага:\n\n{desc}"
     keyboard = [
         [InlineKeyboardButton("✅ Отправить", callback_data="confirm_bug")],
@@ -1008,49 +3817,64 @@ async def show_bug_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         [InlineKeyboardButton("❌ Отмена", callback_data="cancel_bug")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_with_media(context.bot, user_id, text, reply_markup, draft_media(data))
 
-    if media:
-        if update.message and update.message.photo:
-            await update.message.reply_photo(photo=media, caption=text, reply_markup=reply_markup)
-        elif update.message and update.message.video:
-            await update.message.reply_video(video=media, caption=text, reply_markup=reply_markup)
-        else:
-            await context.bot.send_photo(chat_id=user_id, photo=media, caption=text, reply_markup=reply_markup)
-    else:
-        if update.message:
-            await update.message.reply_text(text, reply_markup=reply_markup)
-        else:
-            await context.bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
-
-    USER_BUG_DATA[user_id]['step'] = 'preview'
+    data['step'] = 'preview'
+    sessions.put(user_id, 'bug', data)
 
 async def skip_task_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Пропустить медиа для ТЗ"""
     user_id = update.effective_user.id
-    if user_id in USER_DATA and USER_DATA[user_id].get('step') == 'awaiting_media':
-        USER_DATA[user_id]['media_file_id'] = None
-        await show_task_preview(update, context)
+    data = await sessions.get(user_id, 'task')
+    if data and data.get('step') == 'awaiting_media':
+        data['media'], data['media_file_id'] = [], None
+        await show_task_preview(update, context, data)
     else:
         await update.message.reply_text("ℹ️ Нет активного процесса создания ТЗ.")
 
 async def skip_bug_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Пропустить медиа для бага"""
     user_id = update.effective_user.id
-    if user_id in USER_BUG_DATA and USER_BUG_DATA[user_id].get('step') == 'awaiting_media':
-        USER_BUG_DATA[user_id]['media_file_id'] = None
-        await show_bug_preview(update, context)
+    data = await sessions.get(user_id, 'bug')
+    if data and data.get('step') == 'awaiting_media':
+        data['media'], data['media_file_id'] = [], None
+        await show_bug_preview(update, context, data)
     else:
         await update.message.reply_text("ℹ️ Нет активного процесса создания бага.")
 
 # === ОБРАБОТЧИК КНОПОК ===
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик нажатий кнопок"""
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-
-    handlers_map = {
+class CallbackRouter:
+    """Маршрутизатор нажатий кнопок: таблицы строятся один раз при старте"""
+
+    def __init__(self):
+        self._static = {}    # callback_data -> handler(update, context)
+        self._entities = {}  # сущность -> handler(update, context, cb)
+
+    def add_static(self, data: str, handler):
+        self._static[data] = handler
+
+    def add_entity(self, entity: str, handler):
+        self._entities[entity] = handler
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Вызвать обработчик кнопки; False — маршрута нет"""
+        data = update.callback_query.data
+        handler = self._static.get(data)
+        if handler is not None:
+            await metrics.measure("callback", data, handler(update, context))
+            return True
+        cb = decode_callback(data)
+        if cb is not None and cb.entity in self._entities:
+            await metrics.measure("callback", f"{cb.entity}:{cb.action}",
+                                  self._entities[cb.entity](update, context, cb))
+            return True
+        return False
+
+def build_callback_router() -> CallbackRouter:
+    """Собрать таблицы маршрутов кнопок"""
+    router = CallbackRouter()
+    static_routes = {
         # ТЗ
         "create_task": create_task_start,
         "confirm_task": confirm_task,
@@ -1060,6 +3884,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Баги
         "create_bug": create_bug_start,
         "confirm_bug": confirm_bug,
+        "bug_duplicate_yes": answer_duplicate_check,
+        "bug_duplicate_no": answer_duplicate_check,
         "edit_bug": edit_bug,
         "cancel_bug": cancel_bug,
         
@@ -1070,66 +3896,427 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         "confirm_application": confirm_application,
         "edit_application": edit_application,
         "cancel_application": cancel_application,
+
+        # Списки
+        "list_active": list_items,
+        "list_completed": list_items,
+        "list_rejected": list_items,
         
         # Админ-панель
         "admin_panel": admin_panel,
         "add_admin_start": add_admin_start,
         "list_admins": list_admins,
+        "outbound_queue": show_outbound_queue,
+        "stats": show_stats,
+        "metrics": show_metrics,
+        "broadcast_confirm": confirm_broadcast,
+        "broadcast_cancel": cancel_broadcast,
         "back_to_main": back_to_main,
     }
+    for data, handler in static_routes.items():
+        router.add_static(data, handler)
+
+    router.add_entity("task", handle_admin_task_action)
+    router.add_entity("bug", handle_bug_action)
+    router.add_entity("application", handle_application_action)
+    router.add_entity("task_list", list_items)
+    router.add_entity("bug_list", list_items)
+    router.add_entity("search", search_page)
+    router.add_entity("broadcast", handle_broadcast_action)
+    return router
 
-    if data in handlers_map:
-        await handlers_map[data](update, context)
-    elif data.startswith("bug_complete_") or data.startswith("bug_progress_") or data.startswith("bug_reject_"):
-        await handle_bug_action(update, context)
-    elif data.startswith("complete_") or data.startswith("reject_"):
-        await handle_admin_task_action(update, context)
-    elif data.startswith("app_approve_") or data.startswith("app_reject_"):
-        await handle_application_action(update, context)
+callback_router = build_callback_router()
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик нажатий кнопок"""
+    query = update.callback_query
+    if recent_callbacks.seen(query.id):
+        logger.info(f"🔁 Повторная доставка нажатия {query.id} пропущена")
+        return
+    # На нажатие отвечает обработчик: ответ может быть всплывающим уведомлением
+    if not await callback_router.dispatch(update, context):
+        await query.answer()
+
+# === ПРИЁМ ОБНОВЛЕНИЙ ===
+
+class AntiFlood:
+    """Антифлуд перед всеми обработчиками: ведра токенов на пользователя и на пару (пользователь, команда).
+
+    Лишние обновления молча отбрасываются до обработчиков, поэтому не стоят ни запросов к БД, ни ответов
+    Bot API. Повторные нажатия одной кнопки и повторы одной команды схлопываются ведром команды.
+    """
+
+    def __init__(self, user_rate: float = FLOOD_USER_RATE, user_burst: float = FLOOD_USER_BURST,
+                 command_rate: float = FLOOD_COMMAND_RATE, command_burst: float = FLOOD_COMMAND_BURST,
+                 max_buckets: int = FLOOD_MAX_BUCKETS):
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.command_rate, self.command_burst = command_rate, command_burst
+        self.max_buckets = max_buckets
+        self._users = {}     # user_id -> TokenBucket
+        self._commands = {}  # (user_id, команда) -> TokenBucket
+        self.rejected_users = 0
+        self.rejected_commands = {}  # команда -> отброшено
+
+    @staticmethod
+    def command_of(update: Update) -> Optional[str]:
+        """Команда или кнопка обновления (None — обычный текст и медиа)"""
+        if update.callback_query and update.callback_query.data:
+            data = update.callback_query.data
+            cb = decode_callback(data)
+            return f"{cb.entity}:{cb.action}" if cb else data
+        message = update.message
+        if message and message.text and message.text.startswith("/"):
+            return message.text.split()[0].split("@")[0]
+        return None
+
+    def _bucket(self, buckets: dict, key, rate: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_buckets:
+                for idle in [k for k, b in buckets.items() if b.is_idle()]:
+                    del buckets[idle]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def allow(self, user_id: int, command: str = None) -> bool:
+        """Пропустить обновление или отбросить его (токены списываются только у пропущенных)"""
+        user = self._bucket(self._users, user_id, self.user_rate, self.user_burst)
+        if user.wait_time() > 0:
+            self.rejected_users += 1
+            return False
+        if command is not None:
+            bucket = self._bucket(self._commands, (user_id, command), self.command_rate, self.command_burst)
+            if bucket.wait_time() > 0:
+                self.rejected_commands[command] = self.rejected_commands.get(command, 0) + 1
+                return False
+            bucket.take()
+        user.take()
+        return True
+
+    @property
+    def rejected(self) -> int:
+        return self.rejected_users + sum(self.rejected_commands.values())
+
+    async def gate(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработчик группы -1: ApplicationHandlerStop не пускает обновление к остальным группам"""
+        user = update.effective_user
+        if user is None or admin_registry.contains(user.id):
+            return
+        if not self.allow(user.id, self.command_of(update)):
+            raise ApplicationHandlerStop
+
+    def render(self) -> list:
+        """Счётчики отброшенных обновлений для /metrics"""
+        metric = "bot_antiflood_rejected_total"
+        lines = [f"# HELP {metric} Обновления, отброшенные антифлудом", f"# TYPE {metric} counter",
+                 f'{metric}{{limit="user",command=""}} {self.rejected_users}']
+        for command, count in sorted(self.rejected_commands.items()):
+            lines.append(f'{metric}{{limit="command",command="{prometheus_label(command)}"}} {count}')
+        return lines
+
+antiflood = AntiFlood()
+metrics.collect(antiflood.render)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления одного пользователя выполняются строго по очереди, разных — одновременно
+    (не более max_workers). Ожидающие своей очереди обновления не занимают рабочие слоты.
+    """
+
+    def __init__(self, max_workers: int = UPDATE_CONCURRENCY, backlog: int = UPDATE_BACKLOG_LIMIT):
+        super().__init__(max_concurrent_updates=backlog)
+        self.max_workers = max_workers
+        self._workers = asyncio.Semaphore(max_workers)
+        self._locks = {}  # user_id -> [Lock, число ожидающих]
+
+    @staticmethod
+    def _ordering_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._ordering_key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+class LocalHttpServer:
+    """Минимальный встроенный HTTP/1.1-сервер на asyncio для локальных эндпоинтов"""
+
+    MAX_BODY = 1024 * 1024
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._routes = {}  # (метод, путь) -> async handler(body, headers) -> (статус, тип, тело)
+        self._server = None
+
+    def route(self, method: str, path: str, handler):
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"🌐 HTTP-сервер слушает http://{self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > self.MAX_BODY:
+                    status, content_type, body = 413, "text/plain", b"payload too large"
+                    headers["connection"] = "close"
+                else:
+                    payload = await reader.readexactly(length) if length else b""
+                    handler = self._routes.get((method, target.split("?", 1)[0]))
+                    if handler is None:
+                        status, content_type, body = 404, "text/plain", b"not found"
+                    else:
+                        try:
+                            status, content_type, body = await handler(payload, headers)
+                        except Exception as e:
+                            logger.error(f"Ошибка обработки HTTP-запроса {target}: {e}")
+                            status, content_type, body = 500, "text/plain", b"internal error"
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+def make_webhook_handler(application: Application, secret: str = None):
+    """Обработчик POST-запросов Telegram: кладёт обновление в очередь приложения"""
+
+    async def handle(body: bytes, headers: dict):
+        if secret and headers.get("x-telegram-bot-api-secret-token") != secret:
+            return 403, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except ValueError:
+            return 400, "text/plain", b"bad request"
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+
+    return handle
+
+async def run_webhook(application: Application, listen: str, port: int, url: str = None,
+                      secret: str = None) -> None:
+    """Запуск в режиме вебхука со встроенным HTTP-эндпоинтом.
+
+    Без url вебхук у Telegram не регистрируется — удобно для локальной проверки:
+    curl -X POST -d @update.json http://127.0.0.1:8443/telegram
+    """
+    server = LocalHttpServer(listen, port)
+    server.route("POST", WEBHOOK_PATH, make_webhook_handler(application, secret))
+
+    async with application:
+        await on_startup(application)
+        await application.start()
+        await server.start()
+        try:
+            if url:
+                await application.bot.set_webhook(
+                    url=url.rstrip("/") + WEBHOOK_PATH,
+                    allowed_updates=ALLOWED_UPDATES,
+                    secret_token=secret,
+                    drop_pending_updates=True
+                )
+            logger.info("✅ Бот запущен в режиме вебхука.")
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            await on_stop(application)
+            await on_shutdown(application)
 
 # === ГЛАВНАЯ ФУНКЦИЯ ===
 
-async def main() -> None:
+async def on_startup(application: Application) -> None:
+    """Инициализация ресурсов перед началом обработки обновлений"""
+    await init_db()
+    await admin_registry.load()
+    await duplicate_index.load()
+    await application_cooldowns.load()
+    await digests.load()
+    outbox.start(application.bot)
+    await broadcaster.resume(application.bot)
+    application.job_queue.run_repeating(
+        refresh_admins, interval=ADMIN_REFRESH_INTERVAL, first=ADMIN_REFRESH_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        flush_sessions, interval=SESSION_FLUSH_INTERVAL, first=SESSION_FLUSH_INTERVAL
+    )
+    application.job_queue.run_repeating(purge_sessions, interval=SESSION_PURGE_INTERVAL, first=0)
+    application.job_queue.run_repeating(flush_digests, interval=DIGEST_INTERVAL, first=DIGEST_INTERVAL)
+    application.job_queue.run_repeating(
+        checkpoint_wal, interval=WAL_CHECKPOINT_INTERVAL, first=WAL_CHECKPOINT_INTERVAL
+    )
+    await metrics.start()
+
+async def on_stop(application: Application) -> None:
+    """Досылка отложенных правок, остановка outbox и рассылок, пока бот ещё может отправлять запросы"""
+    await bug_posts.flush()
+    await outbox.stop()
+    await broadcaster.stop()
+
+async def on_shutdown(application: Application) -> None:
+    """Освобождение ресурсов при остановке бота"""
+    await metrics.stop()
+    await write_batcher.close()
+    await sessions.flush()
+    await db_pool.close()
+
+def build_application(token: str = BOT_TOKEN, concurrency: int = UPDATE_CONCURRENCY,
+                      base_url: str = None) -> Application:
+    """Создать приложение со всеми обработчиками"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(outbound)
+        .concurrent_updates(PerUserUpdateProcessor(concurrency))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+
+    # Антифлуд раньше всех остальных групп обработчиков
+    application.add_handler(TypeHandler(Update, antiflood.gate), group=-1)
+
+    # Команды
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("skip", skip_task_media))
+    application.add_handler(CommandHandler("skip_bug", skip_bug_media))
+    application.add_handler(CommandHandler("cancel", cancel_any_process))
+    application.add_handler(CommandHandler("admin", admin_panel))
+    application.add_handler(CommandHandler("id", get_user_id))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("digest", toggle_digest))
+
+    # Обработчики сообщений
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
+        handle_text_message
+    ))
+    application.add_handler(MessageHandler(
+        (filters.PHOTO | filters.VIDEO) & filters.ChatType.PRIVATE,
+        handle_media_message
+    ))
+    
+    # Обработчик кнопок
+    application.add_handler(CallbackQueryHandler(button_handler))
+
+    # Учёт получателей рассылки — после основных обработчиков, чтобы не задерживать ответ
+    application.add_handler(TypeHandler(Update, user_registry.track), group=1)
+
+    # Замер времени каждого обработчика (пока метрики выключены, обёртка ничего не делает)
+    for handler in application.handlers[0]:
+        handler.callback = metrics.track("handler")(handler.callback)
+    return application
+
+def main() -> None:
     """Главная функция запуска бота"""
+    parser = argparse.ArgumentParser(description="Telegram-бот для ТЗ, багов и заявок")
+    parser.add_argument("--check-db", action="store_true",
+                        help="применить миграции, показать планы горячих запросов и выйти")
+    parser.add_argument("--webhook", action="store_true", help="принимать обновления через вебхук")
+    parser.add_argument("--webhook-url", help="публичный URL для регистрации вебхука у Telegram")
+    parser.add_argument("--webhook-secret", default=WEBHOOK_SECRET, help="секретный токен вебхука")
+    parser.add_argument("--listen", default=WEBHOOK_LISTEN, help="адрес встроенного HTTP-сервера")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT, help="порт встроенного HTTP-сервера")
+    parser.add_argument("--concurrency", type=int, default=UPDATE_CONCURRENCY,
+                        help="сколько обновлений обрабатывать одновременно")
+    parser.add_argument("--metrics", action="store_true", default=METRICS_ENABLED,
+                        help="собирать гистограммы задержек")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="порт эндпоинта /metrics (0 — только /admin stats)")
+    args = parser.parse_args()
+    metrics.enabled = args.metrics
+    metrics.port = args.metrics_port
+
+    if args.check_db:
+        sys.exit(0 if asyncio.run(check_db()) else 1)
+
     try:
-        # Инициализация БД
-        await init_db()
-
-        # Создаем приложение
-        application = Application.builder().token(BOT_TOKEN).build()
-
-        # Команды
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("skip", skip_task_media))
-        application.add_handler(CommandHandler("skip_bug", skip_bug_media))
-        application.add_handler(CommandHandler("cancel", cancel_any_process))
-        application.add_handler(CommandHandler("admin", admin_panel))
-        application.add_handler(CommandHandler("id", get_user_id))
-
-        # Обработчики сообщений
-        application.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-            handle_text_message
-        ))
-        application.add_handler(MessageHandler(
-            (filters.PHOTO | filters.VIDEO) & filters.ChatType.PRIVATE,
-            handle_media_message
-        ))
-        
-        # Обработчик кнопок
-        application.add_handler(CallbackQueryHandler(button_handler))
+        # Пул БД открывается в on_startup и закрывается в on_shutdown
+        application = build_application(concurrency=args.concurrency)
+
+        if args.webhook:
+            asyncio.run(run_webhook(
+                application, args.listen, args.port, args.webhook_url, args.webhook_secret
+            ))
+            return
 
         logger.info("✅ Бот запущен и готов к работе.")
         
-        # Запускаем бота
-        await application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
+        # Запускаем бота (run_polling сам управляет циклом событий)
+        application.run_polling(
+            allowed_updates=ALLOWED_UPDATES,
             drop_pending_updates=True
         )
         
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         logger.error(f"❌ Ошибка при запуске бота: {e}")
         raise
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
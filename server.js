@@ -31,8 +31,11 @@ const storage = multer.diskStorage({
 });
 const upload = multer({ storage });
 
-// База данных
+// База данных (общая с Telegram-ботом): WAL, чтобы чтение не ждало записи бота
 const db = new sqlite3.Database('tasks.db');
+db.configure('busyTimeout', 5000);
+db.run('PRAGMA journal_mode = WAL');
+db.run('PRAGMA synchronous = NORMAL');
 
 // Инициализация БД
 db.serialize(() => {